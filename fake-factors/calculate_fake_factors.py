@@ -3,9 +3,12 @@
 
 import os
 import yaml
+try:
+    from yaml import CSafeLoader as YAMLLoader
+except ImportError:
+    from yaml import SafeLoader as YAMLLoader
 import ROOT
 import numpy
-import copy
 from array import array
 from multiprocessing import Pool
 
@@ -13,6 +16,38 @@ import argparse
 import logging
 logger = logging.getLogger()
 
+#evaluation of fake factors and filling of the output tree for many events
+#without Python overhead per event
+ROOT.gInterpreter.Declare("""
+#include <algorithm>
+#include "TTree.h"
+
+void fill_tree(TTree* tree, const double* values, size_t num_rows,
+               size_t num_columns, double* buffer) {
+    for (size_t i = 0; i < num_rows; i++) {
+        const double* row = values + i * num_columns;
+        std::copy(row, row + num_columns, buffer);
+        tree->Fill();
+    }
+}
+""")
+#requires the FakeFactor header in the include path of the CMSSW area
+has_fake_factor_batch = ROOT.gInterpreter.Declare("""
+#include "HTTutilities/Jet2TauFakes/interface/FakeFactor.h"
+
+void evaluate_fake_factor_batch(FakeFactor* ff, size_t num_rows,
+                                size_t num_inputs, const double* inputs,
+                                const std::vector<std::string>& shifts,
+                                double* values) {
+    for (size_t i = 0; i < num_rows; i++) {
+        const double* row = inputs + i * num_inputs;
+        for (size_t j = 0; j < shifts.size(); j++) {
+            values[j * num_rows + i] = ff->value(num_inputs, row, shifts[j]);
+        }
+    }
+}
+""")
+
 
 def setup_logging(output_file, level=logging.DEBUG):
     logger.setLevel(level)
@@ -114,19 +149,21 @@ def determine_fractions(args, categories):
         }
     }
     fractions = {}
+    bin_edges = {}
+    uniform_binning = {}
     for channel in categories.keys():
         subdict = {}
         for category in categories[channel]:
             subsubdict = {}
+            template = hist_file.Get(
+                "#{ch}#{ch}_{cat}#data_obs#smhtt#Run{era}#{expr}#125#".format(
+                    ch=channel,
+                    cat=category,
+                    era=args.era,
+                    expr=args.config[channel]["expression"]))
             for fraction in composition[channel].keys():
-                subsubdict[fraction] = copy.deepcopy(
-                    hist_file.Get(
-                        "#{ch}#{ch}_{cat}#data_obs#smhtt#Run{era}#{expr}#125#".
-                        format(
-                            ch=channel,
-                            cat=category,
-                            era=args.era,
-                            expr=args.config[channel]["expression"])))
+                subsubdict[fraction] = template.Clone()
+                subsubdict[fraction].SetDirectory(0)
                 subsubdict[fraction].Reset()
             for fraction in composition[channel].keys():
                 if fraction == "QCD":
@@ -145,31 +182,151 @@ def determine_fractions(args, categories):
                     subsubdict["QCD"].Add(subsubdict[fraction], 1.0)
                 else:
                     subsubdict["QCD"].Add(subsubdict[fraction], -1.0)
-            #normalize to data to get fractions
-            denominator_hist = copy.deepcopy(subsubdict["data"])
+            #convert to arrays of bin contents including under- and overflow
+            nbins = template.GetNbinsX()
             for fraction in composition[channel].keys():
-                subsubdict[fraction].Divide(denominator_hist)
+                subsubdict[fraction] = numpy.array([
+                    subsubdict[fraction].GetBinContent(i)
+                    for i in range(nbins + 2)
+                ])
+            #normalize to data to get fractions (zero for empty data bins)
+            nonempty = subsubdict["data"] != 0.0
+            inverse_data = numpy.zeros(nbins + 2)
+            inverse_data[nonempty] = 1.0 / subsubdict["data"][nonempty]
+            for fraction in composition[channel].keys():
+                subsubdict[fraction] = subsubdict[fraction] * inverse_data
             #sanity check: if QCD negative i.e. data < MC, normalize to MC
-            for i in range(subsubdict["QCD"].GetNbinsX()+2):
-                qcd_fraction = subsubdict["QCD"].GetBinContent(i)
-                if qcd_fraction < 0.0:
-                    logger.info("Found bin with negative QCD fraction (%s, %s, index %i). Set fraction to zero and rescale other fractions..."%(channel, category, i))
-                    subsubdict["QCD"].SetBinContent(i, 0)
-                    for fraction in composition[channel].keys():
-                        if not fraction == "data":
-                            subsubdict[fraction].SetBinContent(i, subsubdict[fraction].GetBinContent(i) / (1.0 - qcd_fraction))
-                            logger.debug("Rescaled %s fraction to %f"%(fraction, subsubdict[fraction].GetBinContent(i)))
+            negative = subsubdict["QCD"] < 0.0
+            if negative.any():
+                logger.info(
+                    "Found bins with negative QCD fraction (%s, %s, indices %s). Set fraction to zero and rescale other fractions..."
+                    % (channel, category, numpy.flatnonzero(negative)))
+                scale = 1.0 / (1.0 - subsubdict["QCD"][negative])
+                subsubdict["QCD"][negative] = 0.0
+                for fraction in composition[channel].keys():
+                    if not fraction == "data":
+                        subsubdict[fraction][negative] *= scale
+                        logger.debug(
+                            "Rescaled %s fraction to %s" %
+                            (fraction, subsubdict[fraction][negative]))
             subdict[category] = subsubdict
-        fractions[channel] = subdict
+            #binning is required to be the same for all categories
+            edges = numpy.array([
+                template.GetXaxis().GetBinLowEdge(i)
+                for i in range(1, nbins + 2)
+            ])
+            #axes booked with fixed bin widths have no array of bin edges
+            uniform = template.GetXaxis().GetXbins().GetSize() == 0
+            if not channel in bin_edges:
+                bin_edges[channel] = edges
+                uniform_binning[channel] = uniform
+            elif not (numpy.array_equal(bin_edges[channel], edges)
+                      and uniform_binning[channel] == uniform):
+                logger.critical(
+                    "Fraction histograms of channel %s differ in binning!" %
+                    channel)
+                raise Exception
+        #stack categories to tables indexed by category and bin
+        fractions[channel] = {
+            fraction: numpy.vstack([
+                subdict[category][fraction]
+                for category in categories[channel]
+            ])
+            for fraction in composition[channel].keys()
+        }
     hist_file.Close()
-    return fractions
+    return fractions, bin_edges, uniform_binning
+
+
+#bin indices of values as given by TAxis::FindBin including under- and
+#overflow, computed arithmetically for axes with fixed bin widths and by
+#binary search on the bin edges otherwise (values which are NaN go to the
+#overflow bin as in ROOT)
+def find_bins(edges, values, uniform):
+    nbins = len(edges) - 1
+    if uniform:
+        xmin, xmax = edges[0], edges[-1]
+        bins = numpy.full(len(values), nbins + 1, dtype=numpy.int64)
+        with numpy.errstate(invalid="ignore"):
+            bins[values < xmin] = 0
+            inside = numpy.flatnonzero((values >= xmin) & (values < xmax))
+        #same arithmetic as TAxis::FindBin for fixed bin widths
+        bins[inside] = 1 + (nbins * (values[inside] - xmin) /
+                            (xmax - xmin)).astype(numpy.int64)
+        return bins
+    return numpy.searchsorted(edges, values, side="right")
+
+
+#number of entries read and evaluated at once, bounds the memory of a worker
+#independent of the size of the file
+entries_per_block = 100000
+
 
+#read values of expressions for a block of entries of a tree into numpy
+#arrays (TTree::Draw evaluates up to four expressions per pass over the tree)
+def read_columns(tree, expressions, first_entry, num_entries):
+    tree.SetEstimate(num_entries + 1)
+    expressions = sorted(set(expressions), key=expressions.index)
+    columns = {}
+    for i in range(0, len(expressions), 4):
+        chunk = expressions[i:i + 4]
+        tree.Draw(":".join(chunk), "", "goff", num_entries, first_entry)
+        num_rows = tree.GetSelectedRows()
+        for j, expression in enumerate(chunk):
+            values = tree.GetVal(j)
+            values.SetSize(num_rows)
+            columns[expression] = numpy.frombuffer(
+                values, dtype=numpy.float64, count=num_rows).copy()
+    return columns
 
-def apply_fake_factors(config):
-    args = config[0]
-    datafile = config[1]
-    fractions = config[2]
-    categories = config[3]
+
+#evaluate fake factors of all shifts for all rows of an array of inputs in a
+#single call, returns an array with one row of values per shift
+def evaluate_fake_factors(ff, inputs, shifts):
+    inputs = numpy.ascontiguousarray(inputs, dtype=numpy.float64)
+    values = numpy.zeros((len(shifts), inputs.shape[0]))
+    if has_fake_factor_batch:
+        shifts_vector = ROOT.std.vector("string")()
+        for shift in shifts:
+            shifts_vector.push_back(shift)
+        ROOT.evaluate_fake_factor_batch(ff, inputs.shape[0], inputs.shape[1],
+                                        inputs.ravel(), shifts_vector,
+                                        values.ravel())
+    else:  #fallback reusing a single input buffer for all calls
+        row = array('d', [0.0] * inputs.shape[1])
+        for i in range(inputs.shape[0]):
+            for j in range(inputs.shape[1]):
+                row[j] = inputs[i, j]
+            for k, shift in enumerate(shifts):
+                values[k, i] = ff.value(len(row), row, shift)
+    #sanity check: set values outside of [0, 999] (or NaN) to zero
+    invalid = numpy.logical_not((values >= 0.0) & (values <= 999.0))
+    for shift, num_invalid in zip(shifts, invalid.sum(axis=1)):
+        if num_invalid > 0:
+            logger.debug("Set %i fake factors with shift '%s' to zero." %
+                         (num_invalid, shift))
+    numpy.copyto(values, 0.0, where=invalid)
+    return values
+
+
+#inputs shared by all files, set once per worker process
+worker_config = {}
+
+
+def init_worker(args, fractions, bin_edges, uniform_binning, categories):
+    worker_config["args"] = args
+    worker_config["fractions"] = fractions
+    worker_config["bin_edges"] = bin_edges
+    worker_config["uniform_binning"] = uniform_binning
+    worker_config["categories"] = categories
+
+
+def apply_fake_factors(datafile):
+    args = worker_config["args"]
+    fractions = worker_config["fractions"]
+    bin_edges = worker_config["bin_edges"]
+    uniform_binning = worker_config["uniform_binning"]
+    categories = worker_config["categories"]
 
     unc_shifts = {  #documented in https://twiki.cern.ch/twiki/bin/viewauth/CMS/HiggsToTauTauJet2TauFakes
         "et": [
@@ -204,6 +361,11 @@ def apply_fake_factors(config):
     else:  #sanity check of filenames already done in main
         channel = "tt"
 
+    #use remaining threads to parallelize reading within the file
+    if args.implicit_mt_threads > 1 and hasattr(ROOT.ROOT, "EnableImplicitMT"):
+        if not ROOT.ROOT.IsImplicitMTEnabled():
+            ROOT.ROOT.EnableImplicitMT(args.implicit_mt_threads)
+
     #prepare data inputs
     input_file = ROOT.TFile(os.path.join(args.directory, datafile), "READ")
     input_friend_file = ROOT.TFile(
@@ -233,63 +395,108 @@ def apply_fake_factors(config):
         "mt": [2],
         "tt": [1, 2]
     }
-    output_buffer = {}
+    shifts = [
+        "%s_%s" % (syst, shift) for syst in unc_shifts[channel]
+        for shift in ["up", "down"]
+    ]
+    branches = []
     for x in suffix[channel]:
-        output_buffer["nom_%i" % x] = numpy.zeros(1, dtype=float)
-        output_tree.Branch("ff%i_nom" % x, output_buffer["nom_%i" % x],
-                           "ff%i_nom/D" % x)
-        for syst in unc_shifts[channel]:
-            for shift in ["up", "down"]:
-                output_buffer["%s_%s_%i" % (syst, shift, x)] = numpy.zeros(
-                    1, dtype=float)
-                output_tree.Branch("ff%i_%s_%s" % (x, syst, shift),
-                                   output_buffer["%s_%s_%i" %
-                                                 (syst, shift,
-                                                  x)], "ff%i_%s_%s/D" % (x, syst, shift))
-
-    #fill tree
-    for event in input_tree:
+        branches.append("ff%i_nom" % x)
+        branches += ["ff%i_%s" % (x, shift) for shift in shifts]
+    output_index = {branch: i for i, branch in enumerate(branches)}
+    output_buffer = numpy.zeros(len(branches))  #one slot per branch
+    for i, branch in enumerate(branches):
+        output_tree.Branch(branch, output_buffer[i:i + 1], "%s/D" % branch)
+
+    #inputs required for the evaluation of the fake factors
+    expressions = [
+        "%s_max_index" % channel, args.config[channel]["expression"], "njets",
+        "m_vis"
+    ]
+    if channel == "tt":
+        expressions += ["pt_1", "pt_2", "decayMode_1", "decayMode_2"]
+    else:
+        expressions += ["pt_2", "decayMode_2", "mt_1", "iso_1"]
+    #enable only the branches of the leaves used by the expressions, which
+    #may be formulas, and read them through a tree cache
+    used_branches = set()
+    for expression in expressions:
+        formula = ROOT.TTreeFormula("formula", expression, input_tree)
+        if formula.GetNdim() == 0:
+            logger.critical("Failed to compile expression '%s' for file %s." %
+                            (expression, datafile))
+            raise Exception
+        for i in range(formula.GetNcodes()):
+            leaf = formula.GetLeaf(i)
+            if leaf:
+                used_branches.add(leaf.GetBranch().GetName())
+    for tree in [input_tree, input_friend]:
+        input_branches = [
+            branch for branch in used_branches
+            if tree.GetListOfBranches().FindObject(branch)
+        ]
+        tree.SetBranchStatus("*", 0)
+        tree.SetCacheSize(50 * 1024 * 1024)
+        for branch in input_branches:
+            tree.SetBranchStatus(branch, 1)
+            tree.AddBranchToCache(branch, True)
+        tree.StopCacheLearningPhase()
+
+    #evaluate fake factors and fill the tree block by block, with baskets
+    #large enough to hold all entries of a branch for small files and at most
+    #256 kB per basket otherwise
+    num_events = input_tree.GetEntries()
+    output_tree.SetBasketSize("*", max(32000, min(8 * num_events, 262144)))
+    fraction_names = ["QCD", "W", "TT"] + (["DY"] if channel == "tt" else [])
+    for first_entry in range(0, num_events, entries_per_block):
+        num_entries = min(entries_per_block, num_events - first_entry)
+        columns = read_columns(input_tree, expressions, first_entry,
+                               num_entries)
+        max_index = columns["%s_max_index" % channel]
+        bin_index = find_bins(bin_edges[channel],
+                              columns[args.config[channel]["expression"]],
+                              uniform_binning[channel])
+        num_rows = len(max_index)
+        output_values = numpy.zeros((num_rows, len(branches)))
         for x in suffix[channel]:
-            inputs = []
-            cat_fractions = fractions[channel][categories[channel][int(
-                getattr(event, "%s_max_index" % channel) +
-                (0.5 * len(categories[channel])
-                 if channel == "tt" and x == 2 else 0.0))]]
-            bin_index = cat_fractions["data"].GetXaxis().FindBin(getattr(event, args.config[channel]["expression"]))
+            #categories of the second tau in tt are stored after the first ones
+            offset = len(categories[channel]) // 2 if (channel == "tt"
+                                                         and x == 2) else 0
+            category_index = max_index.astype(numpy.int64) + offset
+            event_fractions = [
+                fractions[channel][fraction][category_index, bin_index]
+                for fraction in fraction_names
+            ]
             if channel == "tt":
-                inputs = [
-                    getattr(event, "pt_%i" % x),
-                    getattr(event, "pt_%i" % (3 - x)),
-                    getattr(event, "decayMode_%i" % x), event.njets,
-                    event.m_vis, cat_fractions["QCD"].GetBinContent(bin_index),
-                    cat_fractions["W"].GetBinContent(bin_index),
-                    cat_fractions["TT"].GetBinContent(bin_index),
-                    cat_fractions["DY"].GetBinContent(bin_index)
+                variables = [
+                    columns["pt_%i" % x], columns["pt_%i" % (3 - x)],
+                    columns["decayMode_%i" % x], columns["njets"],
+                    columns["m_vis"]
                 ]
             else:
-                inputs = [
-                    event.pt_2, event.decayMode_2, event.njets, event.m_vis,
-                    event.mt_1, event.iso_1,
-                    cat_fractions["QCD"].GetBinContent(bin_index),
-                    cat_fractions["W"].GetBinContent(bin_index),
-                    cat_fractions["TT"].GetBinContent(bin_index)
+                variables = [
+                    columns["pt_2"], columns["decayMode_2"], columns["njets"],
+                    columns["m_vis"], columns["mt_1"], columns["iso_1"]
                 ]
-            output_buffer["nom_%i" % x][0] = ff.value(
-                len(inputs), array('d', inputs))
-            if not (output_buffer["nom_%i" % x][0] >= 0.0 and output_buffer["nom_%i" % x][0] <= 999.0):
-                output_buffer["nom_%i" % x][0] = 0.0
-            for syst in unc_shifts[channel]:
-                for shift in ["up", "down"]:
-                    output_buffer["%s_%s_%i" % (syst, shift, x)][0] = ff.value(
-                        len(inputs), array('d', inputs), "%s_%s" % (syst,
-                                                                    shift))
-                    if not (output_buffer["%s_%s_%i" % (syst, shift, x)][0] >= 0.0 and output_buffer["%s_%s_%i" % (syst, shift, x)][0] <= 999.0):
-                        #output_buffer["%s_%s_%i" % (syst, shift, x)][0] = 0.0
-                        print syst + shift
-                        print output_buffer["%s_%s_%i" % (syst, shift, x)][0]
-                        print inputs
-                        output_buffer["%s_%s_%i" % (syst, shift, x)][0] = 0.0
-        output_tree.Fill()
+            inputs = numpy.column_stack(variables + event_fractions)
+
+            nominal_values = evaluate_fake_factors(ff, inputs, [""])[0]
+            output_values[:, output_index["ff%i_nom" % x]] = nominal_values
+
+            #shifted fake factors are only evaluated for events with a non-zero
+            #nominal fake factor and set to zero otherwise
+            nonzero = numpy.flatnonzero(nominal_values)
+            logger.debug(
+                "Found %i of %i events with zero nominal fake factor." %
+                (num_rows - len(nonzero), num_rows))
+            shifted_values = evaluate_fake_factors(ff, inputs[nonzero],
+                                                   shifts)
+            for shift, values in zip(shifts, shifted_values):
+                column = output_index["ff%i_%s" % (x, shift)]
+                output_values[nonzero, column] = values
+
+        ROOT.fill_tree(output_tree, output_values.ravel(), num_rows,
+                       len(branches), output_buffer)
 
     #save
     output_tree.Write()
@@ -304,7 +511,8 @@ def apply_fake_factors(config):
 
 
 def main(args):
-    config = yaml.load(open("fake-factors/config.yaml"))
+    with open("fake-factors/config.yaml") as config_file:
+        config = yaml.load(config_file, Loader=YAMLLoader)
     if not args.config in config.keys():
         logger.critical("Requested config key %s not available in fake-factors/config.yaml!" % args.config)
         raise Exception
@@ -318,7 +526,8 @@ def main(args):
             "tt2_ggh", "tt2_qqh", "tt2_ztt", "tt2_noniso", "tt2_misc"
         ]
     }
-    fractions = determine_fractions(args, categories)
+    fractions, bin_edges, uniform_binning = determine_fractions(
+        args, categories)
 
     #find paths to data files the fake factors are appended
     datafiles = []
@@ -372,10 +581,23 @@ def main(args):
         logger.info("Createt output directory")
 
     logger.info("Create friend trees...")
+    if not has_fake_factor_batch:
+        logger.warning(
+            "Compiled fake factor evaluation not available, use slow fallback."
+        )
 
-    pool = Pool(processes=args.num_threads)
-    pool.map(apply_fake_factors, [[args, datafile, fractions, categories]
-                                  for datafile in datafiles])
+    #one process per file, remaining threads are used within the processes
+    num_processes = max(1, min(args.num_threads, len(datafiles)))
+    args.implicit_mt_threads = args.num_threads // num_processes
+    logger.info("Use %i processes with %i threads each." %
+                (num_processes, max(1, args.implicit_mt_threads)))
+    pool = Pool(
+        processes=num_processes,
+        initializer=init_worker,
+        initargs=(args, fractions, bin_edges, uniform_binning, categories))
+    chunksize = max(1, len(datafiles) // (4 * num_processes))
+    for _ in pool.imap_unordered(apply_fake_factors, datafiles, chunksize):
+        pass
     pool.close()
     pool.join()
     del pool
@@ -99,6 +99,10 @@ def main(args):
         logger.critical("Selected unkown STXS signals {}", args.stxs_signals)
         raise Exception
     signal_names = [signal.replace("125", "") for signal in signals]
+    signal_colors = {
+        name: styles.color_dict[name.split("_")[0]]
+        for name in signal_names
+    }
 
     channel_dict = {
         "ee": "ee",
@@ -140,7 +144,7 @@ def main(args):
                 plot.subplot(0).setGraphStyle(
                     name,
                     "hist",
-                    linecolor=styles.color_dict[name.split("_")[0]],
+                    linecolor=signal_colors[name],
                     linewidth=5)
                 plot.subplot(0).get_hist(name).SetLineStyle(
                     signal_linestlyes[i])
@@ -15,15 +15,162 @@ from shape_producer.process import Process
 from shape_producer.estimation_methods import AddHistogramEstimationMethod
 from shape_producer.channel import ETSM, MTSM, TTSM
 
-from itertools import product
+from multiprocessing.pool import ThreadPool
 
 import argparse
+import hashlib
+import importlib
+import marshal
+import os
+import tempfile
 import yaml
+try:
+    from yaml import CSafeLoader as YAMLLoader
+except ImportError:
+    from yaml import SafeLoader as YAMLLoader
 
 import logging
 logger = logging.getLogger()
 
 
+# Implemented eras with their era class and estimation methods
+ERAS = {"2016": ("Run2016", "shape_producer.estimation_methods_2016")}
+
+# Processes with the same estimation method in all channels
+# yapf: disable
+COMMON_PROCESSES = [
+    ("data",                 "data_obs",                "DataEstimation"),
+    ("HTT",                  "HTT",                     "HTTEstimation"),
+    ("ggH",                  "ggH125",                  "ggHEstimation"),
+    ("qqH",                  "qqH125",                  "qqHEstimation"),
+    ("ggH_0J",               "ggH_0J125",               "ggHEstimation_0J"),
+    ("ggH_1J_PTH_0_60",      "ggH_1J_PTH_0_60125",      "ggHEstimation_1J_PTH_0_60"),
+    ("ggH_1J_PTH_60_120",    "ggH_1J_PTH_60_120125",    "ggHEstimation_1J_PTH_60_120"),
+    ("ggH_1J_PTH_120_200",   "ggH_1J_PTH_120_200125",   "ggHEstimation_1J_PTH_120_200"),
+    ("ggH_1J_PTH_GT200",     "ggH_1J_PTH_GT200125",     "ggHEstimation_1J_PTH_GT200"),
+    ("ggH_GE2J_PTH_0_60",    "ggH_GE2J_PTH_0_60125",    "ggHEstimation_GE2J_PTH_0_60"),
+    ("ggH_GE2J_PTH_60_120",  "ggH_GE2J_PTH_60_120125",  "ggHEstimation_GE2J_PTH_60_120"),
+    ("ggH_GE2J_PTH_120_200", "ggH_GE2J_PTH_120_200125", "ggHEstimation_GE2J_PTH_120_200"),
+    ("ggH_GE2J_PTH_GT200",   "ggH_GE2J_PTH_GT200125",   "ggHEstimation_GE2J_PTH_GT200"),
+    ("ggH_VBFTOPO_JET3VETO", "ggH_VBFTOPO_JET3VETO125", "ggHEstimation_VBFTOPO_JET3VETO"),
+    ("ggH_VBFTOPO_JET3",     "ggH_VBFTOPO_JET3125",     "ggHEstimation_VBFTOPO_JET3"),
+    ("qqH_VBFTOPO_JET3VETO", "qqH_VBFTOPO_JET3VETO125", "qqHEstimation_VBFTOPO_JET3VETO"),
+    ("qqH_VBFTOPO_JET3",     "qqH_VBFTOPO_JET3125",     "qqHEstimation_VBFTOPO_JET3"),
+    ("qqH_REST",             "qqH_REST125",             "qqHEstimation_REST"),
+    ("qqH_VH2JET",           "qqH_VH2JET125",           "qqHEstimation_VH2JET"),
+    ("qqH_PTJET1_GT200",     "qqH_PTJET1_GT200125",     "qqHEstimation_PTJET1_GT200"),
+    ("VH",                   "VH125",                   "VHEstimation"),
+    ("W",                    "W",                       "WEstimation"),
+    ("EWKZ",                 "EWKZ",                    "EWKZEstimation"),
+    ("EMB",                  "EMB",                     "ZTTEmbeddedEstimation")
+]
+
+# Processes with channel-specific estimation methods
+CHANNEL_ESTIMATIONS = {
+    "ZTT" : {"mt": "ZTTEstimation",    "et": "ZTTEstimation",    "tt": "ZTTEstimationTT"},
+    "ZL"  : {"mt": "ZLEstimationMTSM", "et": "ZLEstimationETSM", "tt": "ZLEstimationTT"},
+    "ZJ"  : {"mt": "ZJEstimationMT",   "et": "ZJEstimationET",   "tt": "ZJEstimationTT"},
+    "TTT" : {"mt": "TTTEstimationMT",  "et": "TTTEstimationET",  "tt": "TTTEstimationTT"},
+    "TTJ" : {"mt": "TTJEstimationMT",  "et": "TTJEstimationET",  "tt": "TTJEstimationTT"},
+    "TTL" : {"mt": "TTLEstimationMT",  "et": "TTLEstimationET",  "tt": "TTLEstimationTT"},
+    "VVT" : {"mt": "VVTEstimationLT",  "et": "VVTEstimationLT",  "tt": "VVTEstimationTT"},
+    "VVJ" : {"mt": "VVJEstimationLT",  "et": "VVJEstimationLT",  "tt": "VVJEstimationTT"}
+}
+FAKE_ESTIMATIONS = {"mt": "FakeEstimationLT", "et": "FakeEstimationLT", "tt": "FakeEstimationTT"}
+QCD_ESTIMATIONS  = {"mt": "QCDEstimationMT",  "et": "QCDEstimationET",  "tt": "QCDEstimationTT"}
+TTTT_ESTIMATIONS = {"mt": "TTTTEstimationMT", "et": "TTTTEstimationET", "tt": "TTTEstimationTT"}
+
+# Processes subtracted from data in the QCD estimation
+QCD_SUBPROCESSES = ("ZTT", "ZJ", "ZL", "W", "TTT", "TTJ", "VVT", "VVJ", "EWKZ")
+QCD_EXTRAPOLATION_FACTORS = {"mt": 1.17, "et": 1.16}
+
+# Signal processes and backgrounds affected by jet energy scale variations
+SIGNAL_NICKS = (
+    "HTT", "VH", "ggH", "qqH", "qqH_VBFTOPO_JET3VETO", "qqH_VBFTOPO_JET3",
+    "qqH_REST", "qqH_PTJET1_GT200", "qqH_VH2JET", "ggH_0J",
+    "ggH_1J_PTH_0_60", "ggH_1J_PTH_60_120", "ggH_1J_PTH_120_200",
+    "ggH_1J_PTH_GT200", "ggH_GE2J_PTH_0_60", "ggH_GE2J_PTH_60_120",
+    "ggH_GE2J_PTH_120_200", "ggH_GE2J_PTH_GT200", "ggH_VBFTOPO_JET3VETO",
+    "ggH_VBFTOPO_JET3"
+)
+GGH_NICKS = tuple(nick for nick in SIGNAL_NICKS if "ggH" in nick)
+JES_PROCESS_NICKS = ("ZTT", "ZL", "ZJ", "W", "TTT", "TTL", "TTJ", "VVT", "VVJ", "EWKZ") + SIGNAL_NICKS
+
+# Nuisance names and pipeline shifts of variations with different pipelines
+TAU_ES_SPECS = [
+    ("CMS_scale_t_3prong_13TeV",        "tauEsThreeProng"),
+    ("CMS_scale_t_1prong_13TeV",        "tauEsOneProng"),
+    ("CMS_scale_t_1prong1pizero_13TeV", "tauEsOneProngPiZeros")
+]
+JET_ES_SPECS = [
+    # Inclusive JES shapes
+    ("CMS_scale_j_13TeV",             "jecUnc"),
+    # Splitted JES shapes
+    ("CMS_scale_j_eta0to3_13TeV",     "jecUncEta0to3"),
+    ("CMS_scale_j_eta0to5_13TeV",     "jecUncEta0to5"),
+    ("CMS_scale_j_eta3to5_13TeV",     "jecUncEta3to5"),
+    ("CMS_scale_j_RelativeBal_13TeV", "jecUncRelativeBal")
+]
+ELE_FAKE_ES_SPECS = [
+    ("CMS_ZLShape_et_1prong_13TeV",        "tauEleFakeEsOneProng"),
+    ("CMS_ZLShape_et_1prong1pizero_13TeV", "tauEleFakeEsOneProngPiZeros")
+]
+MU_FAKE_ES_SPECS = [
+    ("CMS_ZLShape_mt_1prong_13TeV",        "tauMuFakeEsOneProng"),
+    ("CMS_ZLShape_mt_1prong1pizero_13TeV", "tauMuFakeEsOneProngPiZeros")
+]
+BTAG_SPECS = [
+    ("CMS_htt_eff_b_13TeV",    "btagEff"),
+    ("CMS_htt_mistag_b_13TeV", "btagMistag")
+]
+
+# Decay mode reweighting of Z->ll events with a lepton faking a tau, given
+# by the scale factors of one-prong and one-prong plus pi0 decays
+ZLL_WEIGHT_TEMPLATE = "(((decayMode_2 == 0)*{dm0}) + ((decayMode_2 == 1 || decayMode_2 == 2)*{dm1}) + ((decayMode_2 == 10)*1.0))"
+ZLL_ET_WEIGHTS = [
+    ("CMS_eFakeTau_1prong_13TeV",        "0.98*1.12", "1.2",      "Up"),
+    ("CMS_eFakeTau_1prong_13TeV",        "0.98*0.88", "1.2",      "Down"),
+    ("CMS_eFakeTau_1prong1pizero_13TeV", "0.98",      "1.2*1.12", "Up"),
+    ("CMS_eFakeTau_1prong1pizero_13TeV", "0.98",      "1.2*0.88", "Down")
+]
+ZLL_MT_WEIGHTS = [
+    ("CMS_mFakeTau_1prong_13TeV",        "0.75*1.25", "1.0",  "Up"),
+    ("CMS_mFakeTau_1prong_13TeV",        "0.75*0.75", "1.0",  "Down"),
+    ("CMS_mFakeTau_1prong1pizero_13TeV", "0.75",      "1.25", "Up"),
+    ("CMS_mFakeTau_1prong1pizero_13TeV", "0.75",      "0.75", "Down")
+]
+# Zll replacement weights, formatted once at module load
+ZLL_ET_REWEIGHTS = [
+    (name, Weight(ZLL_WEIGHT_TEMPLATE.format(dm0=dm0, dm1=dm1), "decay_mode_reweight"), shift)
+    for name, dm0, dm1, shift in ZLL_ET_WEIGHTS
+]
+ZLL_MT_REWEIGHTS = [
+    (name, Weight(ZLL_WEIGHT_TEMPLATE.format(dm0=dm0, dm1=dm1), "decay_mode_reweight"), shift)
+    for name, dm0, dm1, shift in ZLL_MT_WEIGHTS
+]
+
+# Linear jet to tau fake efficiency weights and decay mode scale factors of
+# embedded events
+JET_TO_TAU_FAKE_WEIGHTS = [
+    ("(1.0+pt_2*0.002)", "Up"),
+    ("(1.0-pt_2*0.002)", "Down")
+]
+DECAY_MODE_WEIGHTS = [
+    ("CMS_3ProngEff_13TeV",    "embeddedDecayModeWeight_effUp_pi0Nom",   "Up"),
+    ("CMS_3ProngEff_13TeV",    "embeddedDecayModeWeight_effDown_pi0Nom", "Down"),
+    ("CMS_1ProngPi0Eff_13TeV", "embeddedDecayModeWeight_effNom_pi0Up",   "Up"),
+    ("CMS_1ProngPi0Eff_13TeV", "embeddedDecayModeWeight_effNom_pi0Down", "Down")
+]
+
+# Classes of the analysis in order of the max_index of the channel
+ANALYSIS_CLASSES = {
+    "et": ["ggh", "qqh", "ztt", "zll", "w", "tt", "ss", "misc"],
+    "mt": ["ggh", "qqh", "ztt", "zll", "w", "tt", "ss", "misc"],
+    "tt": ["ggh", "qqh", "ztt", "noniso", "misc"]
+}
+# yapf: enable
+
+
 def setup_logging(output_file, level=logging.DEBUG):
     logger.setLevel(level)
     formatter = logging.Formatter("%(name)s - %(levelname)s - %(message)s")
@@ -120,27 +267,289 @@ def parse_arguments():
     parser.add_argument(
         "--skip-systematic-variations",
         default=False,
-        type=str,
+        action="store_true",
         help="Do not produce the systematic variations.")
+    parser.add_argument(
+        "--cache-directory",
+        default=None,
+        type=str,
+        help=
+        "Directory for caches reused by repeated runs. Defaults to the directory of the binning configuration."
+    )
+    parser.add_argument(
+        "--prefetch-inputs",
+        action="store_true",
+        default=False,
+        help=
+        "Open the input files of the requested channels in parallel before producing shapes."
+    )
     return parser.parse_args()
 
 
+def load_binning(binning_file, cache_directory=None):
+    # Parsed binning is cached next to the configuration or in the cache
+    # directory and reused as long as the configuration is not modified. The
+    # cache is written with marshal, which cannot execute code on loading, and
+    # only caches of the current user are read.
+    if cache_directory is None:
+        cache_file = binning_file + ".marshal"
+    else:
+        cache_file = os.path.join(
+            cache_directory, "binning_%s.marshal" %
+            hashlib.md5(os.path.abspath(binning_file)).hexdigest())
+    binning_stat = os.stat(binning_file)
+    signature = (binning_stat.st_mtime, binning_stat.st_size)
+    if os.path.exists(cache_file):
+        if os.stat(cache_file).st_uid != os.getuid():
+            logger.warning("Ignore binning cache %s of another user.",
+                           cache_file)
+        else:
+            try:
+                with open(cache_file, "rb") as f:
+                    cached_signature, binning = marshal.loads(f.read())
+                if tuple(cached_signature) == signature:
+                    return binning
+            except (IOError, EOFError, ValueError, TypeError):
+                logger.warning(
+                    "Failed to read binning cache %s, parse %s again.",
+                    cache_file, binning_file)
+    with open(binning_file) as f:
+        binning = yaml.load(f, Loader=YAMLLoader)
+    # Write to a temporary file and move it in place so that concurrent runs
+    # never see a partially written cache
+    temp_file = None
+    try:
+        with tempfile.NamedTemporaryFile(
+                dir=os.path.dirname(os.path.abspath(cache_file)),
+                delete=False) as f:
+            temp_file = f.name
+            f.write(marshal.dumps((signature, binning)))
+        os.rename(temp_file, cache_file)
+    except (IOError, OSError, ValueError):
+        logger.warning("Failed to write binning cache %s.", cache_file)
+        if temp_file is not None and os.path.exists(temp_file):
+            os.remove(temp_file)
+    return binning
+
+
+def open_file(path):
+    # Missing local friend files are expected, remote files are always tried
+    if "://" not in path and not os.path.exists(path):
+        return
+    f = ROOT.TFile.Open(path, "READ")
+    if f:
+        f.Close()
+
+
+def input_files(processes, directory, friend_directories):
+    # Artus outputs read by the estimation methods of the processes and the
+    # matching files in the friend directories, estimation methods combining
+    # other estimations do not read any files themselves
+    paths = set()
+    for process in processes.values():
+        if not hasattr(process.estimation_method, "get_files"):
+            continue
+        for path in process.estimation_method.get_files():
+            paths.add(path)
+            for friend_directory in friend_directories:
+                if friend_directory is not None:
+                    paths.add(path.replace(directory, friend_directory, 1))
+    return paths
+
+
+def prefetch_files(paths, num_threads):
+    logger.info("Prefetch %i input files.", len(paths))
+    pool = ThreadPool(num_threads)
+    pool.map(open_file, sorted(paths))
+    pool.close()
+    pool.join()
+
+
+def load_era(era_name, datasets):
+    for year, (era_class, estimation_module) in ERAS.items():
+        if year in era_name:
+            era_module = importlib.import_module("shape_producer.era")
+            return (getattr(era_module, era_class)(datasets),
+                    importlib.import_module(estimation_module))
+    logger.critical("Era {} is not implemented.".format(era_name))
+    raise Exception
+
+
+def load_estimations(module, channel):
+    names = [estimation for _, _, estimation in COMMON_PROCESSES]
+    names += [
+        estimation[channel] for estimation in CHANNEL_ESTIMATIONS.values()
+    ]
+    names += [
+        FAKE_ESTIMATIONS[channel], QCD_ESTIMATIONS[channel],
+        TTTT_ESTIMATIONS[channel]
+    ]
+    return {name: getattr(module, name) for name in names}
+
+
+# Estimation methods already set up, keyed by class, era, directory, channel
+# and friend directories
+estimation_cache = {}
+
+
+def make_estimation(estimation, era, directory, channel_obj,
+                    friend_directory):
+    if isinstance(friend_directory, list):
+        friends = tuple(friend_directory)
+    else:
+        friends = (friend_directory, )
+    key = (estimation, id(era), directory, id(channel_obj), friends)
+    if not key in estimation_cache:
+        estimation_cache[key] = estimation(
+            era, directory, channel_obj, friend_directory=friend_directory)
+    return estimation_cache[key]
+
+
+def qcd_inputs(processes):
+    return [processes[process] for process in QCD_SUBPROCESSES]
+
+
+def build_processes(estimations, era, directory, channel, channel_obj,
+                    friend_directory, ff_friend_directory):
+    processes = {}
+    for key, name, estimation in COMMON_PROCESSES:
+        processes[key] = Process(name,
+                                 make_estimation(estimations[estimation], era,
+                                                 directory, channel_obj,
+                                                 friend_directory))
+    for key, estimation in CHANNEL_ESTIMATIONS.items():
+        processes[key] = Process(key,
+                                 make_estimation(
+                                     estimations[estimation[channel]], era,
+                                     directory, channel_obj, friend_directory))
+    processes["FAKES"] = Process(
+        "jetFakes",
+        make_estimation(estimations[FAKE_ESTIMATIONS[channel]], era,
+                        directory, channel_obj,
+                        [friend_directory, ff_friend_directory]))
+    qcd_options = {}
+    if channel in QCD_EXTRAPOLATION_FACTORS:
+        qcd_options["extrapolation_factor"] = QCD_EXTRAPOLATION_FACTORS[
+            channel]
+    processes["QCD"] = Process("QCD",
+                               estimations[QCD_ESTIMATIONS[channel]](
+                                   era, directory, channel_obj,
+                                   qcd_inputs(processes), processes["data"],
+                                   **qcd_options))
+    return processes
+
+
+def build_categories(channel, channel_obj, classes, args, binning):
+    categories = []
+    hig16043_binning = binning.get("HIG16043", {}).get(channel, {})
+    analysis_binning = binning.get("analysis", {}).get(channel, {})
+    stxs_binning = binning.get("stxs_stage1", {})
+    gof_binning = binning.get("gof", {}).get(channel, {})
+    # HIG16043 shapes
+    if channel in args.channels and args.HIG16043:
+        for category in ["0jet", "vbf", "boosted"]:
+            bins = hig16043_binning[category]
+            variable = Variable(
+                bins["variable"],
+                VariableBinning(bins["binning"]),
+                expression=bins["expression"])
+            categories.append(
+                Category(
+                    category,
+                    channel_obj,
+                    Cuts(
+                        Cut(bins["cut_unrolling"],
+                            "%s_cut_unrolling_%s" % (channel, category)),
+                        Cut(bins["cut_category"],
+                            "%s_cut_category_%s" % (channel, category))),
+                    variable=variable))
+    # Analysis shapes
+    elif channel in args.channels:
+        score_name = "%s_max_score" % channel
+        threshold = "%s>%s" % (score_name, 1.0 / len(classes))
+        for i, label in enumerate(classes):
+            bins = analysis_binning[label]
+            index_cut = "%s_max_index==%i" % (channel, i)
+            score = Variable(score_name, VariableBinning(bins))
+            categories.append(
+                Category(
+                    label,
+                    channel_obj,
+                    Cuts(Cut(index_cut, "exclusive_score")),
+                    variable=score))
+            if label in ["ggh", "qqh"]:
+                span = bins[-1] - bins[0]
+                stxs_bins = stxs_binning[label]
+                expression = " + ".join([
+                    "%s*(%s+%s)" % (e, score_name, span * i_e)
+                    for i_e, e in enumerate(stxs_bins)
+                ])
+                score_unrolled = Variable(
+                    "%s_unrolled" % score_name,
+                    VariableBinning(analysis_binning[label + "_unrolled"]),
+                    expression=expression)
+                categories.append(
+                    Category(
+                        "%s_unrolled" % label,
+                        channel_obj,
+                        Cuts(
+                            Cut(index_cut, "exclusive_score"),
+                            Cut(threshold, "protect_unrolling")),
+                        variable=score_unrolled))
+    # Goodness of fit shapes
+    elif args.gof_channel == channel:
+        bins = gof_binning[args.gof_variable]
+        score = Variable(
+            args.gof_variable,
+            VariableBinning(bins["bins"]),
+            expression=bins["expression"])
+        cut = bins.get("cut")
+        cuts = Cuts(Cut(cut, "binning")) if cut is not None else Cuts()
+        categories.append(
+            Category(args.gof_variable, channel_obj, cuts, variable=score))
+    return categories
+
+
+def create_many_systematic_variations(specs, variation_type):
+    variations = []
+    for name, shift in specs:
+        variations += create_systematic_variations(name, shift, variation_type)
+    return variations
+
+
+def apply_group(systematics, era, variations, process_nicks, channels,
+                processes, channel_objs):
+    # Processes are looked up once per group instead of once per variation
+    process_rows = [[(channel_objs[channel], processes[channel][process_nick])
+                     for channel in ["et", "mt", "tt"] if channel in channels]
+                    for process_nick in process_nicks]
+    add_systematic_variation = systematics.add_systematic_variation
+    for variation in variations:
+        for row in process_rows:
+            for channel_obj, process in row:
+                add_systematic_variation(
+                    variation=variation,
+                    process=process,
+                    channel=channel_obj,
+                    era=era)
+
+
 def main(args):
     # Container for all distributions to be drawn
     logger.info("Set up shape variations.")
+    logger.info("Use %s backend.", args.backend)
+    if args.skip_systematic_variations:
+        logger.info("Skip production of systematic variations.")
     systematics = Systematics(
-        "{}_shapes.root".format(args.tag),
+        "%s_shapes.root" % args.tag,
         num_threads=args.num_threads,
+        backend=args.backend,
         skip_systematic_variations=args.skip_systematic_variations)
+    # Bound once, called for every nominal and relabeled shape below
+    add_systematic = systematics.add
 
     # Era selection
-    if "2016" in args.era:
-        from shape_producer.estimation_methods_2016 import DataEstimation, HTTEstimation, ggHEstimation, ggHEstimation_0J, ggHEstimation_1J_PTH_0_60, ggHEstimation_1J_PTH_60_120, ggHEstimation_1J_PTH_120_200, ggHEstimation_1J_PTH_GT200, ggHEstimation_GE2J_PTH_0_60, ggHEstimation_GE2J_PTH_60_120, ggHEstimation_GE2J_PTH_120_200, ggHEstimation_GE2J_PTH_GT200, ggHEstimation_VBFTOPO_JET3, ggHEstimation_VBFTOPO_JET3VETO, qqHEstimation, qqHEstimation_VBFTOPO_JET3VETO, qqHEstimation_VBFTOPO_JET3, qqHEstimation_REST, qqHEstimation_VH2JET, qqHEstimation_PTJET1_GT200, VHEstimation, ZTTEstimation, ZTTEstimationTT, ZLEstimationMTSM, ZLEstimationETSM, ZLEstimationTT, ZJEstimationMT, ZJEstimationET, ZJEstimationTT, WEstimation, TTTEstimationMT, TTTEstimationET, TTTEstimationTT, TTJEstimationMT, TTJEstimationET, TTJEstimationTT, VVTEstimationLT, VVJEstimationLT, VVTEstimationTT, VVJEstimationTT, EWKZEstimation, QCDEstimationMT, QCDEstimationET, QCDEstimationTT, ZTTEmbeddedEstimation, TTLEstimationMT, TTLEstimationET, TTLEstimationTT, TTTTEstimationMT, TTTTEstimationET, FakeEstimationLT, FakeEstimationTT
-        from shape_producer.era import Run2016
-        era = Run2016(args.datasets)
-    else:
-        logger.critical("Era {} is not implemented.".format(args.era))
-        raise Exception
+    era, estimation_module = load_era(args.era, args.datasets)
 
     # Channels and processes
     # yapf: disable
@@ -149,454 +558,114 @@ def main(args):
     mt_friend_directory = args.mt_friend_directory
     tt_friend_directory = args.tt_friend_directory
     ff_friend_directory = args.fake_factor_friend_directory
+    # Channel names from the command line are interned like the literals
+    # used as keys throughout the script
+    channels = frozenset(
+        intern(channel) for channel in [args.gof_channel] + args.channels
+        if channel is not None)
+    do_et = "et" in channels
+    do_mt = "mt" in channels
+    do_tt = "tt" in channels
     mt = MTSM()
     if args.QCD_extrap_fit:
         mt.cuts.remove("muon_iso")
         mt.cuts.add(Cut("(iso_1<0.5)*(iso_1>=0.15)", "muon_iso_loose"))
-    mt_processes = {
-        "data"  : Process("data_obs", DataEstimation  (era, directory, mt, friend_directory=mt_friend_directory)),
-        "HTT"   : Process("HTT",      HTTEstimation   (era, directory, mt, friend_directory=mt_friend_directory)),
-        "ggH"   : Process("ggH125",   ggHEstimation   (era, directory, mt, friend_directory=mt_friend_directory)),
-        "qqH"   : Process("qqH125",   qqHEstimation   (era, directory, mt, friend_directory=mt_friend_directory)),
-        "ggH_0J"               : Process("ggH_0J125",               ggHEstimation_0J              (era, directory, mt, friend_directory=mt_friend_directory)),
-        "ggH_1J_PTH_0_60"      : Process("ggH_1J_PTH_0_60125",      ggHEstimation_1J_PTH_0_60     (era, directory, mt, friend_directory=mt_friend_directory)),
-        "ggH_1J_PTH_60_120"    : Process("ggH_1J_PTH_60_120125",    ggHEstimation_1J_PTH_60_120   (era, directory, mt, friend_directory=mt_friend_directory)),
-        "ggH_1J_PTH_120_200"   : Process("ggH_1J_PTH_120_200125",   ggHEstimation_1J_PTH_120_200  (era, directory, mt, friend_directory=mt_friend_directory)),
-        "ggH_1J_PTH_GT200"     : Process("ggH_1J_PTH_GT200125",     ggHEstimation_1J_PTH_GT200    (era, directory, mt, friend_directory=mt_friend_directory)),
-        "ggH_GE2J_PTH_0_60"    : Process("ggH_GE2J_PTH_0_60125",    ggHEstimation_GE2J_PTH_0_60   (era, directory, mt, friend_directory=mt_friend_directory)),
-        "ggH_GE2J_PTH_60_120"  : Process("ggH_GE2J_PTH_60_120125",  ggHEstimation_GE2J_PTH_60_120 (era, directory, mt, friend_directory=mt_friend_directory)),
-        "ggH_GE2J_PTH_120_200" : Process("ggH_GE2J_PTH_120_200125", ggHEstimation_GE2J_PTH_120_200(era, directory, mt, friend_directory=mt_friend_directory)),
-        "ggH_GE2J_PTH_GT200"   : Process("ggH_GE2J_PTH_GT200125",   ggHEstimation_GE2J_PTH_GT200  (era, directory, mt, friend_directory=mt_friend_directory)),
-        "ggH_VBFTOPO_JET3VETO" : Process("ggH_VBFTOPO_JET3VETO125", ggHEstimation_VBFTOPO_JET3VETO(era, directory, mt, friend_directory=mt_friend_directory)),
-        "ggH_VBFTOPO_JET3"     : Process("ggH_VBFTOPO_JET3125",     ggHEstimation_VBFTOPO_JET3    (era, directory, mt, friend_directory=mt_friend_directory)),
-        "qqH_VBFTOPO_JET3VETO" : Process("qqH_VBFTOPO_JET3VETO125", qqHEstimation_VBFTOPO_JET3VETO(era, directory, mt, friend_directory=mt_friend_directory)),
-        "qqH_VBFTOPO_JET3"     : Process("qqH_VBFTOPO_JET3125",     qqHEstimation_VBFTOPO_JET3    (era, directory, mt, friend_directory=mt_friend_directory)),
-        "qqH_REST"             : Process("qqH_REST125",             qqHEstimation_REST            (era, directory, mt, friend_directory=mt_friend_directory)),
-        "qqH_VH2JET"           : Process("qqH_VH2JET125",           qqHEstimation_VH2JET          (era, directory, mt, friend_directory=mt_friend_directory)),
-        "qqH_PTJET1_GT200"     : Process("qqH_PTJET1_GT200125",     qqHEstimation_PTJET1_GT200    (era, directory, mt, friend_directory=mt_friend_directory)),
-        "VH"    : Process("VH125",    VHEstimation    (era, directory, mt, friend_directory=mt_friend_directory)),
-        "ZTT"   : Process("ZTT",      ZTTEstimation   (era, directory, mt, friend_directory=mt_friend_directory)),
-        "ZL"    : Process("ZL",       ZLEstimationMTSM(era, directory, mt, friend_directory=mt_friend_directory)),
-        "ZJ"    : Process("ZJ",       ZJEstimationMT  (era, directory, mt, friend_directory=mt_friend_directory)),
-        "W"     : Process("W",        WEstimation     (era, directory, mt, friend_directory=mt_friend_directory)),
-        "TTT"   : Process("TTT",      TTTEstimationMT (era, directory, mt, friend_directory=mt_friend_directory)),
-        "TTJ"   : Process("TTJ",      TTJEstimationMT (era, directory, mt, friend_directory=mt_friend_directory)),
-        "VVT"   : Process("VVT",      VVTEstimationLT (era, directory, mt, friend_directory=mt_friend_directory)),
-        "VVJ"   : Process("VVJ",      VVJEstimationLT (era, directory, mt, friend_directory=mt_friend_directory)),
-        "EWKZ"  : Process("EWKZ",     EWKZEstimation  (era, directory, mt, friend_directory=mt_friend_directory)),
-        "FAKES" : Process("jetFakes",    FakeEstimationLT(era, directory, mt, friend_directory=[mt_friend_directory, ff_friend_directory])),
-        "EMB"   : Process("EMB", ZTTEmbeddedEstimation(era, directory, mt, friend_directory=mt_friend_directory)),
-        "TTL"   : Process("TTL", TTLEstimationMT (era, directory, mt, friend_directory=mt_friend_directory))
-        }
-
-    mt_processes["QCD"] = Process("QCD", QCDEstimationMT(era, directory, mt, [mt_processes[process] for process in ["ZTT", "ZJ", "ZL", "W", "TTT", "TTJ", "VVT", "VVJ", "EWKZ"]], mt_processes["data"], extrapolation_factor=1.17))
     et = ETSM()
     if args.QCD_extrap_fit:
         et.cuts.remove("ele_iso")
         et.cuts.add(Cut("(iso_1<0.5)*(iso_1>=0.1)", "ele_iso_loose"))
-    et_processes = {
-        "data"  : Process("data_obs", DataEstimation  (era, directory, et, friend_directory=et_friend_directory)),
-        "HTT"   : Process("HTT",      HTTEstimation   (era, directory, et, friend_directory=et_friend_directory)),
-        "ggH"   : Process("ggH125",   ggHEstimation   (era, directory, et, friend_directory=et_friend_directory)),
-        "qqH"   : Process("qqH125",   qqHEstimation   (era, directory, et, friend_directory=et_friend_directory)),
-        "ggH_0J"               : Process("ggH_0J125",               ggHEstimation_0J              (era, directory, et, friend_directory=et_friend_directory)),
-        "ggH_1J_PTH_0_60"      : Process("ggH_1J_PTH_0_60125",      ggHEstimation_1J_PTH_0_60     (era, directory, et, friend_directory=et_friend_directory)),
-        "ggH_1J_PTH_60_120"    : Process("ggH_1J_PTH_60_120125",    ggHEstimation_1J_PTH_60_120   (era, directory, et, friend_directory=et_friend_directory)),
-        "ggH_1J_PTH_120_200"   : Process("ggH_1J_PTH_120_200125",   ggHEstimation_1J_PTH_120_200  (era, directory, et, friend_directory=et_friend_directory)),
-        "ggH_1J_PTH_GT200"     : Process("ggH_1J_PTH_GT200125",     ggHEstimation_1J_PTH_GT200    (era, directory, et, friend_directory=et_friend_directory)),
-        "ggH_GE2J_PTH_0_60"    : Process("ggH_GE2J_PTH_0_60125",    ggHEstimation_GE2J_PTH_0_60   (era, directory, et, friend_directory=et_friend_directory)),
-        "ggH_GE2J_PTH_60_120"  : Process("ggH_GE2J_PTH_60_120125",  ggHEstimation_GE2J_PTH_60_120 (era, directory, et, friend_directory=et_friend_directory)),
-        "ggH_GE2J_PTH_120_200" : Process("ggH_GE2J_PTH_120_200125", ggHEstimation_GE2J_PTH_120_200(era, directory, et, friend_directory=et_friend_directory)),
-        "ggH_GE2J_PTH_GT200"   : Process("ggH_GE2J_PTH_GT200125",   ggHEstimation_GE2J_PTH_GT200  (era, directory, et, friend_directory=et_friend_directory)),
-        "ggH_VBFTOPO_JET3VETO" : Process("ggH_VBFTOPO_JET3VETO125", ggHEstimation_VBFTOPO_JET3VETO(era, directory, et, friend_directory=et_friend_directory)),
-        "ggH_VBFTOPO_JET3"     : Process("ggH_VBFTOPO_JET3125",     ggHEstimation_VBFTOPO_JET3    (era, directory, et, friend_directory=et_friend_directory)),
-        "qqH_VBFTOPO_JET3VETO" : Process("qqH_VBFTOPO_JET3VETO125", qqHEstimation_VBFTOPO_JET3VETO(era, directory, et, friend_directory=et_friend_directory)),
-        "qqH_VBFTOPO_JET3"     : Process("qqH_VBFTOPO_JET3125",     qqHEstimation_VBFTOPO_JET3    (era, directory, et, friend_directory=et_friend_directory)),
-        "qqH_REST"             : Process("qqH_REST125",             qqHEstimation_REST            (era, directory, et, friend_directory=et_friend_directory)),
-        "qqH_VH2JET"           : Process("qqH_VH2JET125",           qqHEstimation_VH2JET          (era, directory, et, friend_directory=et_friend_directory)),
-        "qqH_PTJET1_GT200"     : Process("qqH_PTJET1_GT200125",     qqHEstimation_PTJET1_GT200    (era, directory, et, friend_directory=et_friend_directory)),
-        "VH"    : Process("VH125",    VHEstimation    (era, directory, et, friend_directory=et_friend_directory)),
-        "ZTT"   : Process("ZTT",      ZTTEstimation   (era, directory, et, friend_directory=et_friend_directory)),
-        "ZL"    : Process("ZL",       ZLEstimationETSM(era, directory, et, friend_directory=et_friend_directory)),
-        "ZJ"    : Process("ZJ",       ZJEstimationET  (era, directory, et, friend_directory=et_friend_directory)),
-        "W"     : Process("W",        WEstimation     (era, directory, et, friend_directory=et_friend_directory)),
-        "TTT"   : Process("TTT",      TTTEstimationET (era, directory, et, friend_directory=et_friend_directory)),
-        "TTJ"   : Process("TTJ",      TTJEstimationET (era, directory, et, friend_directory=et_friend_directory)),
-        "VVT"   : Process("VVT",      VVTEstimationLT (era, directory, et, friend_directory=et_friend_directory)),
-        "VVJ"   : Process("VVJ",      VVJEstimationLT (era, directory, et, friend_directory=et_friend_directory)),
-        "EWKZ"  : Process("EWKZ",     EWKZEstimation  (era, directory, et, friend_directory=et_friend_directory)),
-        "FAKES" : Process("jetFakes",    FakeEstimationLT(era, directory, et, friend_directory=[et_friend_directory, ff_friend_directory])),
-        "EMB"   : Process("EMB", ZTTEmbeddedEstimation(era, directory, et, friend_directory=et_friend_directory)),
-        "TTL"   : Process("TTL", TTLEstimationET (era, directory, et, friend_directory=et_friend_directory))
-        }
-
-    et_processes["QCD"] = Process("QCD", QCDEstimationET(era, directory, et, [et_processes[process] for process in ["ZTT", "ZJ", "ZL", "W", "TTT", "TTJ", "VVT", "VVJ", "EWKZ"]], et_processes["data"], extrapolation_factor=1.16))
     tt = TTSM()
     if args.QCD_extrap_fit:
         tt.cuts.get("os").invert()
     if args.HIG16043:
         tt.cuts.remove("pt_h")
-    tt_processes = {
-        "data"  : Process("data_obs", DataEstimation  (era, directory, tt, friend_directory=tt_friend_directory)),
-        "HTT"   : Process("HTT",      HTTEstimation   (era, directory, tt, friend_directory=tt_friend_directory)),
-        "ggH"   : Process("ggH125",   ggHEstimation   (era, directory, tt, friend_directory=tt_friend_directory)),
-        "qqH"   : Process("qqH125",   qqHEstimation   (era, directory, tt, friend_directory=tt_friend_directory)),
-        "ggH_0J"               : Process("ggH_0J125",               ggHEstimation_0J              (era, directory, tt, friend_directory=tt_friend_directory)),
-        "ggH_1J_PTH_0_60"      : Process("ggH_1J_PTH_0_60125",      ggHEstimation_1J_PTH_0_60     (era, directory, tt, friend_directory=tt_friend_directory)),
-        "ggH_1J_PTH_60_120"    : Process("ggH_1J_PTH_60_120125",    ggHEstimation_1J_PTH_60_120   (era, directory, tt, friend_directory=tt_friend_directory)),
-        "ggH_1J_PTH_120_200"   : Process("ggH_1J_PTH_120_200125",   ggHEstimation_1J_PTH_120_200  (era, directory, tt, friend_directory=tt_friend_directory)),
-        "ggH_1J_PTH_GT200"     : Process("ggH_1J_PTH_GT200125",     ggHEstimation_1J_PTH_GT200    (era, directory, tt, friend_directory=tt_friend_directory)),
-        "ggH_GE2J_PTH_0_60"    : Process("ggH_GE2J_PTH_0_60125",    ggHEstimation_GE2J_PTH_0_60   (era, directory, tt, friend_directory=tt_friend_directory)),
-        "ggH_GE2J_PTH_60_120"  : Process("ggH_GE2J_PTH_60_120125",  ggHEstimation_GE2J_PTH_60_120 (era, directory, tt, friend_directory=tt_friend_directory)),
-        "ggH_GE2J_PTH_120_200" : Process("ggH_GE2J_PTH_120_200125", ggHEstimation_GE2J_PTH_120_200(era, directory, tt, friend_directory=tt_friend_directory)),
-        "ggH_GE2J_PTH_GT200"   : Process("ggH_GE2J_PTH_GT200125",   ggHEstimation_GE2J_PTH_GT200  (era, directory, tt, friend_directory=tt_friend_directory)),
-        "ggH_VBFTOPO_JET3VETO" : Process("ggH_VBFTOPO_JET3VETO125", ggHEstimation_VBFTOPO_JET3VETO(era, directory, tt, friend_directory=tt_friend_directory)),
-        "ggH_VBFTOPO_JET3"     : Process("ggH_VBFTOPO_JET3125",     ggHEstimation_VBFTOPO_JET3    (era, directory, tt, friend_directory=tt_friend_directory)),
-        "qqH_VBFTOPO_JET3VETO" : Process("qqH_VBFTOPO_JET3VETO125", qqHEstimation_VBFTOPO_JET3VETO(era, directory, tt, friend_directory=tt_friend_directory)),
-        "qqH_VBFTOPO_JET3"     : Process("qqH_VBFTOPO_JET3125",     qqHEstimation_VBFTOPO_JET3    (era, directory, tt, friend_directory=tt_friend_directory)),
-        "qqH_REST"             : Process("qqH_REST125",             qqHEstimation_REST            (era, directory, tt, friend_directory=tt_friend_directory)),
-        "qqH_VH2JET"           : Process("qqH_VH2JET125",           qqHEstimation_VH2JET          (era, directory, tt, friend_directory=tt_friend_directory)),
-        "qqH_PTJET1_GT200"     : Process("qqH_PTJET1_GT200125",     qqHEstimation_PTJET1_GT200    (era, directory, tt, friend_directory=tt_friend_directory)),
-        "VH"    : Process("VH125",    VHEstimation    (era, directory, tt, friend_directory=tt_friend_directory)),
-        "ZTT"   : Process("ZTT",      ZTTEstimationTT (era, directory, tt, friend_directory=tt_friend_directory)),
-        "ZL"    : Process("ZL",       ZLEstimationTT  (era, directory, tt, friend_directory=tt_friend_directory)),
-        "ZJ"    : Process("ZJ",       ZJEstimationTT  (era, directory, tt, friend_directory=tt_friend_directory)),
-        "W"     : Process("W",        WEstimation     (era, directory, tt, friend_directory=tt_friend_directory)),
-        "TTT"   : Process("TTT",      TTTEstimationTT (era, directory, tt, friend_directory=tt_friend_directory)),
-        "TTJ"   : Process("TTJ",      TTJEstimationTT (era, directory, tt, friend_directory=tt_friend_directory)),
-        "VVT"   : Process("VVT",      VVTEstimationTT (era, directory, tt, friend_directory=tt_friend_directory)),
-        "VVJ"   : Process("VVJ",      VVJEstimationTT (era, directory, tt, friend_directory=tt_friend_directory)),
-        "EWKZ"  : Process("EWKZ",     EWKZEstimation  (era, directory, tt, friend_directory=tt_friend_directory)),
-        "FAKES" : Process("jetFakes",    FakeEstimationTT(era, directory, tt, friend_directory=[tt_friend_directory, ff_friend_directory])),
-        "EMB"   : Process("EMB", ZTTEmbeddedEstimation(era, directory, tt, friend_directory=tt_friend_directory)),
-        "TTL"   : Process("TTL", TTLEstimationTT (era, directory, tt, friend_directory=tt_friend_directory))
-        }
-
-    tt_processes["QCD"] = Process("QCD", QCDEstimationTT(era, directory, tt, [tt_processes[process] for process in ["ZTT", "ZJ", "ZL", "W", "TTT", "TTJ", "VVT", "VVJ", "EWKZ"]], tt_processes["data"]))
-
-    # Variables and categories
-    binning = yaml.load(open(args.binning))
-
-    et_categories = []
-    # HIG16043 shapes
-    if "et" in args.channels and args.HIG16043:
-        for category in ["0jet", "vbf", "boosted"]:
-            variable = Variable(
-                    binning["HIG16043"]["et"][category]["variable"],
-                    VariableBinning(binning["HIG16043"]["et"][category]["binning"]),
-                    expression=binning["HIG16043"]["et"][category]["expression"])
-            et_categories.append(
-                Category(
-                    category,
-                    et,
-                    Cuts(
-                        Cut(binning["HIG16043"]["et"][category]["cut_unrolling"],
-                            "et_cut_unrolling_{}".format(category)),
-                        Cut(binning["HIG16043"]["et"][category]["cut_category"],
-                            "et_cut_category_{}".format(category))
-                        ),
-                    variable=variable))
-    # Analysis shapes
-    elif "et" in args.channels:
-        classes_et = ["ggh", "qqh", "ztt", "zll", "w", "tt", "ss", "misc"]
-        for i, label in enumerate(classes_et):
-            score = Variable(
-                "et_max_score",
-                 VariableBinning(binning["analysis"]["et"][label]))
-            et_categories.append(
-                Category(
-                    label,
-                    et,
-                    Cuts(
-                        Cut("et_max_index=={index}".format(index=i), "exclusive_score")),
-                    variable=score))
-            if label in ["ggh", "qqh"]:
-                expression = ""
-                for i_e, e in enumerate(binning["stxs_stage1"][label]):
-                    offset = (binning["analysis"]["et"][label][-1]-binning["analysis"]["et"][label][0])*i_e
-                    expression += "{STXSBIN}*(et_max_score+{OFFSET})".format(STXSBIN=e, OFFSET=offset)
-                    if not e is binning["stxs_stage1"][label][-1]:
-                        expression += " + "
-                score_unrolled = Variable(
-                    "et_max_score_unrolled",
-                     VariableBinning(binning["analysis"]["et"][label+"_unrolled"]),
-                     expression=expression)
-                et_categories.append(
-                    Category(
-                        "{}_unrolled".format(label),
-                        et,
-                        Cuts(Cut("et_max_index=={index}".format(index=i), "exclusive_score"),
-                             Cut("et_max_score>{}".format(1.0/len(classes_et)), "protect_unrolling")),
-                        variable=score_unrolled))
-    # Goodness of fit shapes
-    elif "et" == args.gof_channel:
-        score = Variable(
-                args.gof_variable,
-                VariableBinning(binning["gof"]["et"][args.gof_variable]["bins"]),
-                expression=binning["gof"]["et"][args.gof_variable]["expression"])
-        if "cut" in binning["gof"]["et"][args.gof_variable].keys():
-            cuts=Cuts(Cut(binning["gof"]["et"][args.gof_variable]["cut"], "binning"))
-        else:
-            cuts=Cuts()
-        et_categories.append(
-            Category(
-                args.gof_variable,
-                et,
-                cuts,
-                variable=score))
-
-    mt_categories = []
-    # HIG16043 shapes
-    if "mt" in args.channels and args.HIG16043:
-        for category in ["0jet", "vbf", "boosted"]:
-            variable = Variable(
-                    binning["HIG16043"]["mt"][category]["variable"],
-                    VariableBinning(binning["HIG16043"]["mt"][category]["binning"]),
-                    expression=binning["HIG16043"]["mt"][category]["expression"])
-            mt_categories.append(
-                Category(
-                    category,
-                    mt,
-                    Cuts(
-                        Cut(binning["HIG16043"]["mt"][category]["cut_unrolling"],
-                            "mt_cut_unrolling_{}".format(category)),
-                        Cut(binning["HIG16043"]["mt"][category]["cut_category"],
-                            "mt_cut_category_{}".format(category))
-                        ),
-                    variable=variable))
-    # Analysis shapes
-    elif "mt" in args.channels:
-        classes_mt = ["ggh", "qqh", "ztt", "zll", "w", "tt", "ss", "misc"]
-        for i, label in enumerate(classes_mt):
-            score = Variable(
-                "mt_max_score",
-                 VariableBinning(binning["analysis"]["mt"][label]))
-            mt_categories.append(
-                Category(
-                    label,
-                    mt,
-                    Cuts(
-                        Cut("mt_max_index=={index}".format(index=i), "exclusive_score")),
-                    variable=score))
-            if label in ["ggh", "qqh"]:
-                expression = ""
-                for i_e, e in enumerate(binning["stxs_stage1"][label]):
-                    offset = (binning["analysis"]["mt"][label][-1]-binning["analysis"]["mt"][label][0])*i_e
-                    expression += "{STXSBIN}*(mt_max_score+{OFFSET})".format(STXSBIN=e, OFFSET=offset)
-                    if not e is binning["stxs_stage1"][label][-1]:
-                        expression += " + "
-                score_unrolled = Variable(
-                    "mt_max_score_unrolled",
-                     VariableBinning(binning["analysis"]["mt"][label+"_unrolled"]),
-                     expression=expression)
-                mt_categories.append(
-                    Category(
-                        "{}_unrolled".format(label),
-                        mt,
-                        Cuts(Cut("mt_max_index=={index}".format(index=i), "exclusive_score"),
-                             Cut("mt_max_score>{}".format(1.0/len(classes_mt)), "protect_unrolling")),
-                        variable=score_unrolled))
-    # Goodness of fit shapes
-    elif args.gof_channel == "mt":
-        score = Variable(
-                args.gof_variable,
-                VariableBinning(binning["gof"]["mt"][args.gof_variable]["bins"]),
-                expression=binning["gof"]["mt"][args.gof_variable]["expression"])
-        if "cut" in binning["gof"]["mt"][args.gof_variable].keys():
-            cuts=Cuts(Cut(binning["gof"]["mt"][args.gof_variable]["cut"], "binning"))
-        else:
-            cuts=Cuts()
-        mt_categories.append(
-            Category(
-                args.gof_variable,
-                mt,
-                cuts,
-                variable=score))
-
-    tt_categories = []
-    # HIG16043 shapes
-    if "tt" in args.channels and args.HIG16043:
-        for category in ["0jet", "vbf", "boosted"]:
-            variable = Variable(
-                    binning["HIG16043"]["tt"][category]["variable"],
-                    VariableBinning(binning["HIG16043"]["tt"][category]["binning"]),
-                    expression=binning["HIG16043"]["tt"][category]["expression"])
-            tt_categories.append(
-                Category(
-                    category,
-                    tt,
-                    Cuts(
-                        Cut(binning["HIG16043"]["tt"][category]["cut_unrolling"],
-                            "tt_cut_unrolling_{}".format(category)),
-                        Cut(binning["HIG16043"]["tt"][category]["cut_category"],
-                            "tt_cut_category_{}".format(category))
-                        ),
-                    variable=variable))
-    # Analysis shapes
-    elif "tt" in args.channels:
-        classes_tt = ["ggh", "qqh", "ztt", "noniso", "misc"]
-        for i, label in enumerate(classes_tt):
-            score = Variable(
-                "tt_max_score",
-                 VariableBinning(binning["analysis"]["tt"][label]))
-            tt_categories.append(
-                Category(
-                    label,
-                    tt,
-                    Cuts(
-                        Cut("tt_max_index=={index}".format(index=i), "exclusive_score")),
-                    variable=score))
-            if label in ["ggh", "qqh"]:
-                expression = ""
-                for i_e, e in enumerate(binning["stxs_stage1"][label]):
-                    offset = (binning["analysis"]["tt"][label][-1]-binning["analysis"]["tt"][label][0])*i_e
-                    expression += "{STXSBIN}*(tt_max_score+{OFFSET})".format(STXSBIN=e, OFFSET=offset)
-                    if not e is binning["stxs_stage1"][label][-1]:
-                        expression += " + "
-                score_unrolled = Variable(
-                    "tt_max_score_unrolled",
-                     VariableBinning(binning["analysis"]["tt"][label+"_unrolled"]),
-                     expression=expression)
-                tt_categories.append(
-                    Category(
-                        "{}_unrolled".format(label),
-                        tt,
-                        Cuts(Cut("tt_max_index=={index}".format(index=i), "exclusive_score"),
-                             Cut("tt_max_score>{}".format(1.0/len(classes_tt)), "protect_unrolling")),
-                        variable=score_unrolled))
-    # Goodness of fit shapes
-    elif args.gof_channel == "tt":
-        score = Variable(
-                args.gof_variable,
-                VariableBinning(binning["gof"]["tt"][args.gof_variable]["bins"]),
-                expression=binning["gof"]["tt"][args.gof_variable]["expression"])
-        if "cut" in binning["gof"]["tt"][args.gof_variable].keys():
-            cuts=Cuts(Cut(binning["gof"]["tt"][args.gof_variable]["cut"], "binning"))
-        else:
-            cuts=Cuts()
-        tt_categories.append(
-            Category(
-                args.gof_variable,
-                tt,
-                cuts,
-                variable=score))
-
-    # Nominal histograms
+    mt_estimations = load_estimations(estimation_module, "mt")
+    et_estimations = load_estimations(estimation_module, "et")
+    tt_estimations = load_estimations(estimation_module, "tt")
     # yapf: enable
-    signal_nicks = [
-        "HTT", "VH", "ggH", "qqH", "qqH_VBFTOPO_JET3VETO", "qqH_VBFTOPO_JET3",
-        "qqH_REST", "qqH_PTJET1_GT200", "qqH_VH2JET", "ggH_0J",
-        "ggH_1J_PTH_0_60", "ggH_1J_PTH_60_120", "ggH_1J_PTH_120_200",
-        "ggH_1J_PTH_GT200", "ggH_GE2J_PTH_0_60", "ggH_GE2J_PTH_60_120",
-        "ggH_GE2J_PTH_120_200", "ggH_GE2J_PTH_GT200", "ggH_VBFTOPO_JET3VETO",
-        "ggH_VBFTOPO_JET3"
-    ]
 
-    if "et" in [args.gof_channel] + args.channels:
-        for process, category in product(et_processes.values(), et_categories):
-            systematics.add(
-                Systematic(
-                    category=category,
-                    process=process,
-                    analysis="smhtt",
-                    era=era,
-                    variation=Nominal(),
-                    mass="125"))
+    # Set up processes of the requested channels
+    mt_processes = build_processes(
+        mt_estimations, era, directory, "mt", mt, mt_friend_directory,
+        ff_friend_directory) if do_mt else {}
+    et_processes = build_processes(
+        et_estimations, era, directory, "et", et, et_friend_directory,
+        ff_friend_directory) if do_et else {}
+    tt_processes = build_processes(
+        tt_estimations, era, directory, "tt", tt, tt_friend_directory,
+        ff_friend_directory) if do_tt else {}
+
+    if args.prefetch_inputs:
+        paths = set()
+        for processes, friend_directory in [
+            (mt_processes, mt_friend_directory),
+            (et_processes, et_friend_directory),
+            (tt_processes, tt_friend_directory)
+        ]:
+            paths.update(
+                input_files(processes, directory,
+                            [friend_directory, ff_friend_directory]))
+        ROOT.ROOT.EnableThreadSafety()
+        prefetch_files(paths, max(1, min(8, args.num_threads)))
+        # Also prefetch baskets of remote files asynchronously while reading
+        ROOT.gEnv.SetValue("TFile.AsyncPrefetching", 1)
 
-    if "mt" in [args.gof_channel] + args.channels:
-        for process, category in product(mt_processes.values(), mt_categories):
-            systematics.add(
-                Systematic(
-                    category=category,
-                    process=process,
-                    analysis="smhtt",
-                    era=era,
-                    variation=Nominal(),
-                    mass="125"))
-    if "tt" in [args.gof_channel] + args.channels:
-        for process, category in product(tt_processes.values(), tt_categories):
-            systematics.add(
-                Systematic(
-                    category=category,
-                    process=process,
-                    analysis="smhtt",
-                    era=era,
-                    variation=Nominal(),
-                    mass="125"))
+    # Variables and categories
+    binning = load_binning(args.binning, args.cache_directory)
+
+    et_categories = build_categories("et", et, ANALYSIS_CLASSES["et"], args,
+                                     binning)
+    mt_categories = build_categories("mt", mt, ANALYSIS_CLASSES["mt"], args,
+                                     binning)
+    tt_categories = build_categories("tt", tt, ANALYSIS_CLASSES["tt"], args,
+                                     binning)
+
+    # Nominal histograms, all sharing a single stateless variation object
+    nominal = Nominal()
+    if do_et:
+        for process in et_processes.values():
+            for category in et_categories:
+                add_systematic(
+                    Systematic(
+                        category=category,
+                        process=process,
+                        analysis="smhtt",
+                        era=era,
+                        variation=nominal,
+                        mass="125"))
+
+    if do_mt:
+        for process in mt_processes.values():
+            for category in mt_categories:
+                add_systematic(
+                    Systematic(
+                        category=category,
+                        process=process,
+                        analysis="smhtt",
+                        era=era,
+                        variation=nominal,
+                        mass="125"))
+    if do_tt:
+        for process in tt_processes.values():
+            for category in tt_categories:
+                add_systematic(
+                    Systematic(
+                        category=category,
+                        process=process,
+                        analysis="smhtt",
+                        era=era,
+                        variation=nominal,
+                        mass="125"))
 
     # Shapes variations
 
     # Tau energy scale
-    tau_es_3prong_variations = create_systematic_variations(
-        "CMS_scale_t_3prong_13TeV", "tauEsThreeProng", DifferentPipeline)
-    tau_es_1prong_variations = create_systematic_variations(
-        "CMS_scale_t_1prong_13TeV", "tauEsOneProng", DifferentPipeline)
-    tau_es_1prong1pizero_variations = create_systematic_variations(
-        "CMS_scale_t_1prong1pizero_13TeV", "tauEsOneProngPiZeros",
-        DifferentPipeline)
-    for variation in tau_es_3prong_variations + tau_es_1prong_variations + tau_es_1prong1pizero_variations:
-        for process_nick in ["ZTT", "TTT", "TTL", "VVT", "EWKZ", "EMB"
-                             ] + signal_nicks:
-            if "et" in [args.gof_channel] + args.channels:
-                systematics.add_systematic_variation(
-                    variation=variation,
-                    process=et_processes[process_nick],
-                    channel=et,
-                    era=era)
-            if "mt" in [args.gof_channel] + args.channels:
-                systematics.add_systematic_variation(
-                    variation=variation,
-                    process=mt_processes[process_nick],
-                    channel=mt,
-                    era=era)
-            if "tt" in [args.gof_channel] + args.channels:
-                systematics.add_systematic_variation(
-                    variation=variation,
-                    process=tt_processes[process_nick],
-                    channel=tt,
-                    era=era)
+    tau_es_variations = create_many_systematic_variations(
+        TAU_ES_SPECS, DifferentPipeline)
 
     # Jet energy scale
-
-    # Inclusive JES shapes
-    jet_es_variations = []
-    jet_es_variations += create_systematic_variations(
-        "CMS_scale_j_13TeV", "jecUnc", DifferentPipeline)
-
-    # Splitted JES shapes
-    jet_es_variations += create_systematic_variations(
-        "CMS_scale_j_eta0to3_13TeV", "jecUncEta0to3", DifferentPipeline)
-    jet_es_variations += create_systematic_variations(
-        "CMS_scale_j_eta0to5_13TeV", "jecUncEta0to5", DifferentPipeline)
-    jet_es_variations += create_systematic_variations(
-        "CMS_scale_j_eta3to5_13TeV", "jecUncEta3to5", DifferentPipeline)
-    jet_es_variations += create_systematic_variations(
-        "CMS_scale_j_RelativeBal_13TeV", "jecUncRelativeBal",
-        DifferentPipeline)
-
-    for variation in jet_es_variations:
-        for process_nick in [
-                "ZTT", "ZL", "ZJ", "W", "TTT", "TTL", "TTJ", "VVT", "VVJ",
-                "EWKZ"
-        ] + signal_nicks:
-            if "et" in [args.gof_channel] + args.channels:
-                systematics.add_systematic_variation(
-                    variation=variation,
-                    process=et_processes[process_nick],
-                    channel=et,
-                    era=era)
-            if "mt" in [args.gof_channel] + args.channels:
-                systematics.add_systematic_variation(
-                    variation=variation,
-                    process=mt_processes[process_nick],
-                    channel=mt,
-                    era=era)
-            if "tt" in [args.gof_channel] + args.channels:
-                systematics.add_systematic_variation(
-                    variation=variation,
-                    process=tt_processes[process_nick],
-                    channel=tt,
-                    era=era)
+    jet_es_variations = create_many_systematic_variations(
+        JET_ES_SPECS, DifferentPipeline)
 
     # MET energy scale
     met_unclustered_variations = create_systematic_variations(
@@ -605,425 +674,148 @@ def main(args):
     # NOTE: Clustered MET not used anymore in the uncertainty model
     #met_clustered_variations = create_systematic_variations(
     #    "CMS_scale_met_clustered_13TeV", "metJetEn", DifferentPipeline)
-    for variation in met_unclustered_variations:  # + met_clustered_variations:
-        for process_nick in [
-                "ZTT", "ZL", "ZJ", "W", "TTT", "TTL", "TTJ", "VVT", "VVJ",
-                "EWKZ"
-        ] + signal_nicks:
-            if "et" in [args.gof_channel] + args.channels:
-                systematics.add_systematic_variation(
-                    variation=variation,
-                    process=et_processes[process_nick],
-                    channel=et,
-                    era=era)
-            if "mt" in [args.gof_channel] + args.channels:
-                systematics.add_systematic_variation(
-                    variation=variation,
-                    process=mt_processes[process_nick],
-                    channel=mt,
-                    era=era)
-            if "tt" in [args.gof_channel] + args.channels:
-                systematics.add_systematic_variation(
-                    variation=variation,
-                    process=tt_processes[process_nick],
-                    channel=tt,
-                    era=era)
 
     # Z pt reweighting
     zpt_variations = create_systematic_variations(
         "CMS_htt_dyShape_13TeV", "zPtReweightWeight", SquareAndRemoveWeight)
-    for variation in zpt_variations:
-        for process_nick in ["ZTT", "ZL", "ZJ"]:
-            if "et" in [args.gof_channel] + args.channels:
-                systematics.add_systematic_variation(
-                    variation=variation,
-                    process=et_processes[process_nick],
-                    channel=et,
-                    era=era)
-            if "mt" in [args.gof_channel] + args.channels:
-                systematics.add_systematic_variation(
-                    variation=variation,
-                    process=mt_processes[process_nick],
-                    channel=mt,
-                    era=era)
-            if "tt" in [args.gof_channel] + args.channels:
-                systematics.add_systematic_variation(
-                    variation=variation,
-                    process=tt_processes[process_nick],
-                    channel=tt,
-                    era=era)
 
     # top pt reweighting
     top_pt_variations = create_systematic_variations(
         "CMS_htt_ttbarShape_13TeV", "topPtReweightWeight",
         SquareAndRemoveWeight)
-    for variation in top_pt_variations:
-        for process_nick in ["TTT", "TTL", "TTJ"]:
-            if "et" in [args.gof_channel] + args.channels:
-                systematics.add_systematic_variation(
-                    variation=variation,
-                    process=et_processes[process_nick],
-                    channel=et,
-                    era=era)
-            if "mt" in [args.gof_channel] + args.channels:
-                systematics.add_systematic_variation(
-                    variation=variation,
-                    process=mt_processes[process_nick],
-                    channel=mt,
-                    era=era)
-            if "tt" in [args.gof_channel] + args.channels:
-                systematics.add_systematic_variation(
-                    variation=variation,
-                    process=tt_processes[process_nick],
-                    channel=tt,
-                    era=era)
 
     # jet to tau fake efficiency
-    jet_to_tau_fake_variations = []
-    jet_to_tau_fake_variations.append(
-        AddWeight("CMS_htt_jetToTauFake_13TeV", "jetToTauFake_weight",
-                  Weight("(1.0+pt_2*0.002)", "jetToTauFake_weight"), "Up"))
-    jet_to_tau_fake_variations.append(
+    jet_to_tau_fake_variations = [
         AddWeight("CMS_htt_jetToTauFake_13TeV", "jetToTauFake_weight",
-                  Weight("(1.0-pt_2*0.002)", "jetToTauFake_weight"), "Down"))
-    for variation in jet_to_tau_fake_variations:
-        for process_nick in ["ZJ", "TTJ", "W", "VVJ"]:
-            if "et" in [args.gof_channel] + args.channels:
-                systematics.add_systematic_variation(
-                    variation=variation,
-                    process=et_processes[process_nick],
-                    channel=et,
-                    era=era)
-            if "mt" in [args.gof_channel] + args.channels:
-                systematics.add_systematic_variation(
-                    variation=variation,
-                    process=mt_processes[process_nick],
-                    channel=mt,
-                    era=era)
-            if "tt" in [args.gof_channel] + args.channels:
-                systematics.add_systematic_variation(
-                    variation=variation,
-                    process=tt_processes[process_nick],
-                    channel=tt,
-                    era=era)
+                  Weight(weight, "jetToTauFake_weight"), shift)
+        for weight, shift in JET_TO_TAU_FAKE_WEIGHTS
+    ]
 
     # ZL fakes energy scale
-    ele_fake_es_1prong_variations = create_systematic_variations(
-        "CMS_ZLShape_et_1prong_13TeV", "tauEleFakeEsOneProng",
-        DifferentPipeline)
-    ele_fake_es_1prong1pizero_variations = create_systematic_variations(
-        "CMS_ZLShape_et_1prong1pizero_13TeV", "tauEleFakeEsOneProngPiZeros",
-        DifferentPipeline)
-
-    if "et" in [args.gof_channel] + args.channels:
-        for process_nick in ["ZL"]:
-            for variation in ele_fake_es_1prong_variations + ele_fake_es_1prong1pizero_variations:
-                systematics.add_systematic_variation(
-                    variation=variation,
-                    process=et_processes[process_nick],
-                    channel=et,
-                    era=era)
-
-    mu_fake_es_1prong_variations = create_systematic_variations(
-        "CMS_ZLShape_mt_1prong_13TeV", "tauMuFakeEsOneProng",
-        DifferentPipeline)
-    mu_fake_es_1prong1pizero_variations = create_systematic_variations(
-        "CMS_ZLShape_mt_1prong1pizero_13TeV", "tauMuFakeEsOneProngPiZeros",
-        DifferentPipeline)
-
-    if "mt" in [args.gof_channel] + args.channels:
-        for process_nick in ["ZL"]:
-            for variation in mu_fake_es_1prong_variations + mu_fake_es_1prong1pizero_variations:
-                systematics.add_systematic_variation(
-                    variation=variation,
-                    process=mt_processes[process_nick],
-                    channel=mt,
-                    era=era)
+    ele_fake_es_variations = create_many_systematic_variations(
+        ELE_FAKE_ES_SPECS, DifferentPipeline)
+    mu_fake_es_variations = create_many_systematic_variations(
+        MU_FAKE_ES_SPECS, DifferentPipeline)
 
     # Zll reweighting
-    zll_et_weight_variations = []
-    zll_et_weight_variations.append(
-        ReplaceWeight(
-            "CMS_eFakeTau_1prong_13TeV", "decay_mode_reweight",
-            Weight(
-                "(((decayMode_2 == 0)*0.98*1.12) + ((decayMode_2 == 1 || decayMode_2 == 2)*1.2) + ((decayMode_2 == 10)*1.0))",
-                "decay_mode_reweight"), "Up"))
-    zll_et_weight_variations.append(
-        ReplaceWeight(
-            "CMS_eFakeTau_1prong_13TeV", "decay_mode_reweight",
-            Weight(
-                "(((decayMode_2 == 0)*0.98*0.88) + ((decayMode_2 == 1 || decayMode_2 == 2)*1.2) + ((decayMode_2 == 10)*1.0))",
-                "decay_mode_reweight"), "Down"))
-    zll_et_weight_variations.append(
-        ReplaceWeight(
-            "CMS_eFakeTau_1prong1pizero_13TeV", "decay_mode_reweight",
-            Weight(
-                "(((decayMode_2 == 0)*0.98) + ((decayMode_2 == 1 || decayMode_2 == 2)*1.2*1.12) + ((decayMode_2 == 10)*1.0))",
-                "decay_mode_reweight"), "Up"))
-    zll_et_weight_variations.append(
-        ReplaceWeight(
-            "CMS_eFakeTau_1prong1pizero_13TeV", "decay_mode_reweight",
-            Weight(
-                "(((decayMode_2 == 0)*0.98) + ((decayMode_2 == 1 || decayMode_2 == 2)*1.2*0.88) + ((decayMode_2 == 10)*1.0))",
-                "decay_mode_reweight"), "Down"))
-    for variation in zll_et_weight_variations:
-        for process_nick in ["ZL"]:
-            if "et" in [args.gof_channel] + args.channels:
-                systematics.add_systematic_variation(
-                    variation=variation,
-                    process=et_processes[process_nick],
-                    channel=et,
-                    era=era)
-    zll_mt_weight_variations = []
-    zll_mt_weight_variations.append(
-        ReplaceWeight(
-            "CMS_mFakeTau_1prong_13TeV", "decay_mode_reweight",
-            Weight(
-                "(((decayMode_2 == 0)*0.75*1.25) + ((decayMode_2 == 1 || decayMode_2 == 2)*1.0) + ((decayMode_2 == 10)*1.0))",
-                "decay_mode_reweight"), "Up"))
-    zll_mt_weight_variations.append(
-        ReplaceWeight(
-            "CMS_mFakeTau_1prong_13TeV", "decay_mode_reweight",
-            Weight(
-                "(((decayMode_2 == 0)*0.75*0.75) + ((decayMode_2 == 1 || decayMode_2 == 2)*1.0) + ((decayMode_2 == 10)*1.0))",
-                "decay_mode_reweight"), "Down"))
-    zll_mt_weight_variations.append(
-        ReplaceWeight(
-            "CMS_mFakeTau_1prong1pizero_13TeV", "decay_mode_reweight",
-            Weight(
-                "(((decayMode_2 == 0)*0.75) + ((decayMode_2 == 1 || decayMode_2 == 2)*1.25) + ((decayMode_2 == 10)*1.0))",
-                "decay_mode_reweight"), "Up"))
-    zll_mt_weight_variations.append(
-        ReplaceWeight(
-            "CMS_mFakeTau_1prong1pizero_13TeV", "decay_mode_reweight",
-            Weight(
-                "(((decayMode_2 == 0)*0.75) + ((decayMode_2 == 1 || decayMode_2 == 2)*0.75) + ((decayMode_2 == 10)*1.0))",
-                "decay_mode_reweight"), "Down"))
-    for variation in zll_mt_weight_variations:
-        for process_nick in ["ZL"]:
-            if "mt" in [args.gof_channel] + args.channels:
-                systematics.add_systematic_variation(
-                    variation=variation,
-                    process=mt_processes[process_nick],
-                    channel=mt,
-                    era=era)
+    zll_et_weight_variations = [
+        ReplaceWeight(name, "decay_mode_reweight", weight, shift)
+        for name, weight, shift in ZLL_ET_REWEIGHTS
+    ]
+    zll_mt_weight_variations = [
+        ReplaceWeight(name, "decay_mode_reweight", weight, shift)
+        for name, weight, shift in ZLL_MT_REWEIGHTS
+    ]
 
     # b tagging
-    btag_eff_variations = create_systematic_variations(
-        "CMS_htt_eff_b_13TeV", "btagEff", DifferentPipeline)
-    mistag_eff_variations = create_systematic_variations(
-        "CMS_htt_mistag_b_13TeV", "btagMistag", DifferentPipeline)
-    for variation in btag_eff_variations + mistag_eff_variations:
-        for process_nick in [
-                "ZTT", "ZL", "ZJ", "W", "TTT", "TTL", "TTJ", "VVT", "VVJ",
-                "EWKZ"
-        ] + signal_nicks:
-            if "et" in [args.gof_channel] + args.channels:
-                systematics.add_systematic_variation(
-                    variation=variation,
-                    process=et_processes[process_nick],
-                    channel=et,
-                    era=era)
-            if "mt" in [args.gof_channel] + args.channels:
-                systematics.add_systematic_variation(
-                    variation=variation,
-                    process=mt_processes[process_nick],
-                    channel=mt,
-                    era=era)
-            if "tt" in [args.gof_channel] + args.channels:
-                systematics.add_systematic_variation(
-                    variation=variation,
-                    process=tt_processes[process_nick],
-                    channel=tt,
-                    era=era)
+    btag_variations = create_many_systematic_variations(
+        BTAG_SPECS, DifferentPipeline)
+
     # Embedded event specifics
-    mt_decayMode_variations = []
-    mt_decayMode_variations.append(
-        ReplaceWeight(
-            "CMS_3ProngEff_13TeV", "decayMode_SF",
-            Weight("embeddedDecayModeWeight_effUp_pi0Nom", "decayMode_SF"),
-            "Up"))
-    mt_decayMode_variations.append(
-        ReplaceWeight(
-            "CMS_3ProngEff_13TeV", "decayMode_SF",
-            Weight("embeddedDecayModeWeight_effDown_pi0Nom", "decayMode_SF"),
-            "Down"))
-    mt_decayMode_variations.append(
-        ReplaceWeight(
-            "CMS_1ProngPi0Eff_13TeV", "decayMode_SF",
-            Weight("embeddedDecayModeWeight_effNom_pi0Up", "decayMode_SF"),
-            "Up"))
-    mt_decayMode_variations.append(
-        ReplaceWeight(
-            "CMS_1ProngPi0Eff_13TeV", "decayMode_SF",
-            Weight("embeddedDecayModeWeight_effNom_pi0Down", "decayMode_SF"),
-            "Down"))
-    for variation in mt_decayMode_variations:
-        for process_nick in ["EMB"]:
-            if "mt" in args.channels:
-                systematics.add_systematic_variation(
-                    variation=variation,
-                    process=mt_processes[process_nick],
-                    channel=mt,
-                    era=era)
-    et_decayMode_variations = []
-    et_decayMode_variations.append(
-        ReplaceWeight(
-            "CMS_3ProngEff_13TeV", "decayMode_SF",
-            Weight("embeddedDecayModeWeight_effUp_pi0Nom", "decayMode_SF"),
-            "Up"))
-    et_decayMode_variations.append(
-        ReplaceWeight(
-            "CMS_3ProngEff_13TeV", "decayMode_SF",
-            Weight("embeddedDecayModeWeight_effDown_pi0Nom", "decayMode_SF"),
-            "Down"))
-    et_decayMode_variations.append(
-        ReplaceWeight(
-            "CMS_1ProngPi0Eff_13TeV", "decayMode_SF",
-            Weight("embeddedDecayModeWeight_effNom_pi0Up", "decayMode_SF"),
-            "Up"))
-    et_decayMode_variations.append(
-        ReplaceWeight(
-            "CMS_1ProngPi0Eff_13TeV", "decayMode_SF",
-            Weight("embeddedDecayModeWeight_effNom_pi0Down", "decayMode_SF"),
-            "Down"))
-    for variation in et_decayMode_variations:
-        for process_nick in ["EMB"]:
-            if "et" in args.channels:
-                systematics.add_systematic_variation(
-                    variation=variation,
-                    process=et_processes[process_nick],
-                    channel=et,
-                    era=era)
-    tt_decayMode_variations = []
-    tt_decayMode_variations.append(
-        ReplaceWeight(
-            "CMS_3ProngEff_13TeV", "decayMode_SF",
-            Weight("embeddedDecayModeWeight_effUp_pi0Nom", "decayMode_SF"),
-            "Up"))
-    tt_decayMode_variations.append(
-        ReplaceWeight(
-            "CMS_3ProngEff_13TeV", "decayMode_SF",
-            Weight("embeddedDecayModeWeight_effDown_pi0Nom", "decayMode_SF"),
-            "Down"))
-    tt_decayMode_variations.append(
-        ReplaceWeight(
-            "CMS_1ProngPi0Eff_13TeV", "decayMode_SF",
-            Weight("embeddedDecayModeWeight_effNom_pi0Up", "decayMode_SF"),
-            "Up"))
-    tt_decayMode_variations.append(
-        ReplaceWeight(
-            "CMS_1ProngPi0Eff_13TeV", "decayMode_SF",
-            Weight("embeddedDecayModeWeight_effNom_pi0Down", "decayMode_SF"),
-            "Down"))
-    for variation in tt_decayMode_variations:
-        for process_nick in ["EMB"]:
-            if "tt" in args.channels:
-                systematics.add_systematic_variation(
-                    variation=variation,
-                    process=tt_processes[process_nick],
-                    channel=tt,
-                    era=era)
+    decayMode_variations = [
+        ReplaceWeight(name, "decayMode_SF", Weight(weight, "decayMode_SF"),
+                      shift) for name, weight, shift in DECAY_MODE_WEIGHTS
+    ]
+
     # 10% removed events in ttbar simulation (ttbar -> real tau tau events) will be added/subtracted to ZTT shape to use as systematic
-    tttautau_process_mt = Process(
-        "TTTT",
-        TTTTEstimationMT(
-            era, directory, mt, friend_directory=mt_friend_directory))
-    tttautau_process_et = Process(
-        "TTTT",
-        TTTTEstimationET(
-            era, directory, et, friend_directory=et_friend_directory))
-    tttautau_process_tt = Process(
-        "TTTT",
-        TTTEstimationTT(
-            era, directory, tt, friend_directory=tt_friend_directory))
-    if 'mt' in [args.gof_channel] + args.channels:
+    emb_ttbar_down = Relabel("CMS_htt_emb_ttbar_13TeV", "Down")
+    emb_ttbar_up = Relabel("CMS_htt_emb_ttbar_13TeV", "Up")
+    if do_mt:
+        tttautau_process_mt = Process(
+            "TTTT",
+            make_estimation(mt_estimations[TTTT_ESTIMATIONS["mt"]], era,
+                            directory, mt, mt_friend_directory))
+        mt_processes['ZTTpTTTauTauDown'] = Process(
+            "ZTTpTTTauTauDown",
+            AddHistogramEstimationMethod(
+                "AddHistogram", "nominal", era, directory, mt,
+                [mt_processes["EMB"], tttautau_process_mt], [1.0, -0.1]))
+        mt_processes['ZTTpTTTauTauUp'] = Process(
+            "ZTTpTTTauTauUp",
+            AddHistogramEstimationMethod(
+                "AddHistogram", "nominal", era, directory, mt,
+                [mt_processes["EMB"], tttautau_process_mt], [1.0, 0.1]))
         for category in mt_categories:
-            mt_processes['ZTTpTTTauTauDown'] = Process(
-                "ZTTpTTTauTauDown",
-                AddHistogramEstimationMethod(
-                    "AddHistogram", "nominal", era, directory, mt,
-                    [mt_processes["EMB"], tttautau_process_mt], [1.0, -0.1]))
-            systematics.add(
+            add_systematic(
                 Systematic(
                     category=category,
                     process=mt_processes['ZTTpTTTauTauDown'],
                     analysis="smhtt",
                     era=era,
-                    variation=Relabel("CMS_htt_emb_ttbar_13TeV", "Down"),
+                    variation=emb_ttbar_down,
                     mass="125"))
-
-            mt_processes['ZTTpTTTauTauUp'] = Process(
-                "ZTTpTTTauTauUp",
-                AddHistogramEstimationMethod(
-                    "AddHistogram", "nominal", era, directory, mt,
-                    [mt_processes["EMB"], tttautau_process_mt], [1.0, 0.1]))
-            systematics.add(
+            add_systematic(
                 Systematic(
                     category=category,
                     process=mt_processes['ZTTpTTTauTauUp'],
                     analysis="smhtt",
                     era=era,
-                    variation=Relabel("CMS_htt_emb_ttbar_13TeV", "Up"),
+                    variation=emb_ttbar_up,
                     mass="125"))
 
-    if 'et' in [args.gof_channel] + args.channels:
+    if do_et:
+        tttautau_process_et = Process(
+            "TTTT",
+            make_estimation(et_estimations[TTTT_ESTIMATIONS["et"]], era,
+                            directory, et, et_friend_directory))
+        et_processes['ZTTpTTTauTauDown'] = Process(
+            "ZTTpTTTauTauDown",
+            AddHistogramEstimationMethod(
+                "AddHistogram", "nominal", era, directory, et,
+                [et_processes["EMB"], tttautau_process_et], [1.0, -0.1]))
+        et_processes['ZTTpTTTauTauUp'] = Process(
+            "ZTTpTTTauTauUp",
+            AddHistogramEstimationMethod(
+                "AddHistogram", "nominal", era, directory, et,
+                [et_processes["EMB"], tttautau_process_et], [1.0, 0.1]))
         for category in et_categories:
-            et_processes['ZTTpTTTauTauDown'] = Process(
-                "ZTTpTTTauTauDown",
-                AddHistogramEstimationMethod(
-                    "AddHistogram", "nominal", era, directory, et,
-                    [et_processes["EMB"], tttautau_process_et], [1.0, -0.1]))
-            systematics.add(
+            add_systematic(
                 Systematic(
                     category=category,
                     process=et_processes['ZTTpTTTauTauDown'],
                     analysis="smhtt",
                     era=era,
-                    variation=Relabel("CMS_htt_emb_ttbar_13TeV", "Down"),
+                    variation=emb_ttbar_down,
                     mass="125"))
-
-            et_processes['ZTTpTTTauTauUp'] = Process(
-                "ZTTpTTTauTauUp",
-                AddHistogramEstimationMethod(
-                    "AddHistogram", "nominal", era, directory, et,
-                    [et_processes["EMB"], tttautau_process_et], [1.0, 0.1]))
-            systematics.add(
+            add_systematic(
                 Systematic(
                     category=category,
                     process=et_processes['ZTTpTTTauTauUp'],
                     analysis="smhtt",
                     era=era,
-                    variation=Relabel("CMS_htt_emb_ttbar_13TeV", "Up"),
+                    variation=emb_ttbar_up,
                     mass="125"))
-    if 'tt' in [args.gof_channel] + args.channels:
+    if do_tt:
+        tttautau_process_tt = Process(
+            "TTTT",
+            make_estimation(tt_estimations[TTTT_ESTIMATIONS["tt"]], era,
+                            directory, tt, tt_friend_directory))
+        tt_processes['ZTTpTTTauTauDown'] = Process(
+            "ZTTpTTTauTauDown",
+            AddHistogramEstimationMethod(
+                "AddHistogram", "EMB", era, directory, tt,
+                [tt_processes["EMB"], tttautau_process_tt], [1.0, -0.1]))
+        tt_processes['ZTTpTTTauTauUp'] = Process(
+            "ZTTpTTTauTauUp",
+            AddHistogramEstimationMethod(
+                "AddHistogram", "nominal", era, directory, tt,
+                [tt_processes["EMB"], tttautau_process_tt], [1.0, 0.1]))
         for category in tt_categories:
-            tt_processes['ZTTpTTTauTauDown'] = Process(
-                "ZTTpTTTauTauDown",
-                AddHistogramEstimationMethod(
-                    "AddHistogram", "EMB", era, directory, tt,
-                    [tt_processes["EMB"], tttautau_process_tt], [1.0, -0.1]))
-            systematics.add(
+            add_systematic(
                 Systematic(
                     category=category,
                     process=tt_processes['ZTTpTTTauTauDown'],
                     analysis="smhtt",
                     era=era,
-                    variation=Relabel("CMS_htt_emb_ttbar_13TeV", "Down"),
+                    variation=emb_ttbar_down,
                     mass="125"))
-
-            tt_processes['ZTTpTTTauTauUp'] = Process(
-                "ZTTpTTTauTauUp",
-                AddHistogramEstimationMethod(
-                    "AddHistogram", "nominal", era, directory, tt,
-                    [tt_processes["EMB"], tttautau_process_tt], [1.0, 0.1]))
-            systematics.add(
+            add_systematic(
                 Systematic(
                     category=category,
                     process=tt_processes['ZTTpTTTauTauUp'],
                     analysis="smhtt",
                     era=era,
-                    variation=Relabel("CMS_htt_emb_ttbar_13TeV", "Up"),
+                    variation=emb_ttbar_up,
                     mass="125"))
 
     # Fake factor uncertainties
@@ -1044,41 +836,20 @@ def main(args):
             "ff_tt_dm1_njet0_stat_13TeV{shift}",
             "ff_tt_dm1_njet1_stat_13TeV{shift}"
     ]:
+        name_et = "CMS_%s" % systematic_shift.format(ch="_et", shift="")
+        name_mt = "CMS_%s" % systematic_shift.format(ch="_mt", shift="")
         for shift_direction in ["Up", "Down"]:
+            syst = systematic_shift.format(
+                ch="", shift="_%s" % shift_direction.lower()).replace(
+                    "_13TeV", "")
             fake_factor_variations_et.append(
-                ReplaceWeight(
-                    "CMS_%s" % (systematic_shift.format(ch='_et', shift="")),
-                    "fake_factor",
-                    Weight(
-                        "ff2_{syst}".format(
-                            syst=systematic_shift.format(
-                                ch="", shift="_%s" % shift_direction.lower())
-                            .replace("_13TeV", "")),
-                        "fake_factor"), shift_direction))
+                ReplaceWeight(name_et, "fake_factor",
+                              Weight("ff2_%s" % syst, "fake_factor"),
+                              shift_direction))
             fake_factor_variations_mt.append(
-                ReplaceWeight(
-                    "CMS_%s" % (systematic_shift.format(ch='_mt', shift="")),
-                    "fake_factor",
-                    Weight(
-                        "ff2_{syst}".format(
-                            syst=systematic_shift.format(
-                                ch="", shift="_%s" % shift_direction.lower())
-                            .replace("_13TeV", "")),
-                        "fake_factor"), shift_direction))
-    if "et" in [args.gof_channel] + args.channels:
-        for variation in fake_factor_variations_et:
-            systematics.add_systematic_variation(
-                variation=variation,
-                process=et_processes["FAKES"],
-                channel=et,
-                era=era)
-    if "mt" in [args.gof_channel] + args.channels:
-        for variation in fake_factor_variations_mt:
-            systematics.add_systematic_variation(
-                variation=variation,
-                process=mt_processes["FAKES"],
-                channel=mt,
-                era=era)
+                ReplaceWeight(name_mt, "fake_factor",
+                              Weight("ff2_%s" % syst, "fake_factor"),
+                              shift_direction))
     fake_factor_variations_tt = []
     for systematic_shift in [
             "ff_qcd{ch}_syst_13TeV{shift}",
@@ -1091,25 +862,17 @@ def main(args):
             "ff_tt_frac{ch}_syst_13TeV{shift}",
             "ff_dy_frac{ch}_syst_13TeV{shift}"
     ]:
+        name_tt = "CMS_%s" % systematic_shift.format(ch="_tt", shift="")
         for shift_direction in ["Up", "Down"]:
+            syst = systematic_shift.format(
+                ch="", shift="_%s" % shift_direction.lower()).replace(
+                    "_13TeV", "")
             fake_factor_variations_tt.append(
                 ReplaceWeight(
-                    "CMS_%s" % (systematic_shift.format(ch='_tt', shift="")),
-                    "fake_factor",
+                    name_tt, "fake_factor",
                     Weight(
                         "(0.5*ff1_{syst}*(byTightIsolationMVArun2v1DBoldDMwLT_1<0.5)+0.5*ff2_{syst}*(byTightIsolationMVArun2v1DBoldDMwLT_2<0.5))".
-                        format(
-                            syst=systematic_shift.format(
-                                ch="", shift="_%s" % shift_direction.lower())
-                            .replace("_13TeV", "")),
-                        "fake_factor"), shift_direction))
-    if "tt" in [args.gof_channel] + args.channels:
-        for variation in fake_factor_variations_tt:
-            systematics.add_systematic_variation(
-                variation=variation,
-                process=tt_processes["FAKES"],
-                channel=tt,
-                era=era)
+                        format(syst=syst), "fake_factor"), shift_direction))
 
     # Gluon-fusion WG1 uncertainty scheme
     ggh_variations = []
@@ -1126,26 +889,46 @@ def main(args):
             AddWeight("{}_13TeV".format(unc), "{}_weight".format(unc),
                       Weight("(1.0/{})".format(unc), "{}_weight".format(unc)),
                       "Down"))
-    for variation in ggh_variations:
-        for process_nick in [nick for nick in signal_nicks if "ggH" in nick]:
-            if "et" in [args.gof_channel] + args.channels:
-                systematics.add_systematic_variation(
-                    variation=variation,
-                    process=et_processes[process_nick],
-                    channel=et,
-                    era=era)
-            if "mt" in [args.gof_channel] + args.channels:
-                systematics.add_systematic_variation(
-                    variation=variation,
-                    process=mt_processes[process_nick],
-                    channel=mt,
-                    era=era)
-            if "tt" in [args.gof_channel] + args.channels:
-                systematics.add_systematic_variation(
-                    variation=variation,
-                    process=tt_processes[process_nick],
-                    channel=tt,
-                    era=era)
+
+    # Add shape variations of all groups to the requested channels
+    # yapf: disable
+    shape_groups = [
+        (tau_es_variations,
+         ("ZTT", "TTT", "TTL", "VVT", "EWKZ", "EMB") + SIGNAL_NICKS, {"et", "mt", "tt"}),
+        (jet_es_variations,
+         JES_PROCESS_NICKS, {"et", "mt", "tt"}),
+        (met_unclustered_variations,  # + met_clustered_variations
+         JES_PROCESS_NICKS, {"et", "mt", "tt"}),
+        (zpt_variations, ["ZTT", "ZL", "ZJ"], {"et", "mt", "tt"}),
+        (top_pt_variations, ["TTT", "TTL", "TTJ"], {"et", "mt", "tt"}),
+        (jet_to_tau_fake_variations, ["ZJ", "TTJ", "W", "VVJ"], {"et", "mt", "tt"}),
+        (ele_fake_es_variations, ["ZL"], {"et"}),
+        (mu_fake_es_variations, ["ZL"], {"mt"}),
+        (zll_et_weight_variations, ["ZL"], {"et"}),
+        (zll_mt_weight_variations, ["ZL"], {"mt"}),
+        (btag_variations,
+         JES_PROCESS_NICKS, {"et", "mt", "tt"}),
+        # embedded decay mode variations are not applied for goodness of fit
+        (decayMode_variations, ["EMB"], {"mt", "et", "tt"}.intersection(args.channels)),
+        (fake_factor_variations_et, ["FAKES"], {"et"}),
+        (fake_factor_variations_mt, ["FAKES"], {"mt"}),
+        (fake_factor_variations_tt, ["FAKES"], {"tt"}),
+        (ggh_variations, GGH_NICKS, {"et", "mt", "tt"})
+    ]
+    # yapf: enable
+    # Skipped variations would only be held in memory until produce(), so
+    # they are not set up at all
+    if not args.skip_systematic_variations:
+        processes = {
+            "et": et_processes,
+            "mt": mt_processes,
+            "tt": tt_processes
+        }
+        channel_objs = {"et": et, "mt": mt, "tt": tt}
+        for variations, process_nicks, allowed_channels in shape_groups:
+            apply_group(systematics, era, variations, process_nicks,
+                        channels.intersection(allowed_channels), processes,
+                        channel_objs)
 
     # Produce histograms
     logger.info("Start producing shapes.")
@@ -30,4 +30,4 @@ python shapes/produce_shapes.py \
     --gof-variable $VARIABLE \
     --era $ERA \
     --tag ${ERA}_${CHANNELS} \
-	--skip-systematic-variations true
+	--skip-systematic-variations